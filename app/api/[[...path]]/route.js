@@ -33,12 +33,17 @@ export async function POST(request, { params }) {
         'Content-Type': 'application/json',
       },
       body: JSON.stringify(body),
+      // Abort the backend call when the browser aborts, so the backend sees the disconnect
+      signal: request.signal,
     });
     
     const data = await response.json();
     return NextResponse.json(data, { status: response.status });
     
   } catch (error) {
+    if (error.name === 'AbortError') {
+      return NextResponse.json({ error: 'Request cancelled' }, { status: 499 });
+    }
     console.error('Backend proxy error (POST):', error);
     return NextResponse.json({ 
       error: 'Backend service unavailable',
@@ -6,11 +6,13 @@ import { Input } from '@/components/ui/input';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
 import { Card } from '@/components/ui/card';
 import { Badge } from '@/components/ui/badge';
-import { ScrollArea } from '@/components/ui/scroll-area';
 import { Separator } from '@/components/ui/separator';
 import { Bot, User, Send, Settings, MessageSquare, Plus, Menu, Moon, Sun, RotateCcw } from 'lucide-react';
 import { AVAILABLE_MODELS } from '@/lib/llm-service.ts';
 import MarkdownMessage from '@/components/MarkdownMessage';
+import VirtualMessageList from '@/components/VirtualMessageList';
+import { ChatSocket } from '@/lib/chat-socket';
+import { v4 as uuidv4 } from 'uuid';
 import { memo } from 'react';
 
 // Memoized Message Component for better performance with responsive design
@@ -39,7 +41,12 @@ const MessageItem = memo(({ message, index, darkMode }) => {
             </p>
           </div>
         ) : (
-          <MarkdownMessage content={message.content} darkMode={darkMode} />
+          <>
+            <MarkdownMessage content={message.content} darkMode={darkMode} cacheKey={message.id} />
+            {message.model && (
+              <div className="mt-2 text-xs text-gray-500 dark:text-gray-400">{message.model}</div>
+            )}
+          </>
         )}
       </div>
       
@@ -54,6 +61,13 @@ const MessageItem = memo(({ message, index, darkMode }) => {
 
 MessageItem.displayName = 'MessageItem';
 
+// Messages saved before ids were introduced get one on load
+const withMessageIds = (messages) => messages.map(message => (
+  message.id ? message : { ...message, id: uuidv4() }
+));
+
+const getMessageKey = (message) => message.id;
+
 export default function ChatbotApp() {
   const [provider, setProvider] = useState('openai');
   const [model, setModel] = useState('gpt-4o-mini');
@@ -66,20 +80,21 @@ export default function ChatbotApp() {
   const [sidebarOpen, setSidebarOpen] = useState(false); // Default closed on mobile
   const [availableModels, setAvailableModels] = useState(AVAILABLE_MODELS);
   const [sessionId, setSessionId] = useState(null); // Add session management
-  const messagesEndRef = useRef(null);
-
-  // Scroll to bottom when messages change - optimized with debouncing
-  const scrollToBottom = useCallback(() => {
-    if (messagesEndRef.current) {
-      messagesEndRef.current.scrollIntoView({ behavior: 'smooth' });
-    }
-  }, []);
+  const chatSocketRef = useRef(null);
+  const inflightRef = useRef(null); // { requestId, controller, viaSocket } for the pending reply
 
+  // Keep one persistent chat channel open for the lifetime of the page
   useEffect(() => {
-    // Debounce scroll to bottom to prevent excessive scrolling
-    const timeoutId = setTimeout(scrollToBottom, 100);
-    return () => clearTimeout(timeoutId);
-  }, [messages.length, scrollToBottom]); // Only trigger on message count change
+    const chatSocket = new ChatSocket();
+    chatSocketRef.current = chatSocket;
+    chatSocket.connect().catch(() => {
+      // Falls back to HTTP in handleSubmit
+    });
+    return () => {
+      chatSocketRef.current = null;
+      chatSocket.close();
+    };
+  }, []);
 
   // Load API key and chat data from localStorage
   useEffect(() => {
@@ -96,7 +111,7 @@ export default function ChatbotApp() {
       }
       if (savedMessages) {
         const parsedMessages = JSON.parse(savedMessages);
-        setMessages(parsedMessages);
+        setMessages(withMessageIds(parsedMessages));
       }
       if (savedSessionId) {
         setSessionId(savedSessionId);
@@ -128,7 +143,7 @@ export default function ChatbotApp() {
           
           // Load saved model or use first available model for current provider
           const savedModel = localStorage.getItem('selected_model');
-          if (savedModel && data.models[provider] && data.models[provider].includes(savedModel)) {
+          if (savedModel === 'auto' || (savedModel && data.models[provider] && data.models[provider].includes(savedModel))) {
             setModel(savedModel);
           } else if (data.models[provider]) {
             setModel(data.models[provider][0]);
@@ -138,7 +153,7 @@ export default function ChatbotApp() {
         console.error('Failed to fetch models:', error);
         // Fallback to static models
         const savedModel = localStorage.getItem('selected_model');
-        if (savedModel && AVAILABLE_MODELS[provider] && AVAILABLE_MODELS[provider].includes(savedModel)) {
+        if (savedModel === 'auto' || (savedModel && AVAILABLE_MODELS[provider] && AVAILABLE_MODELS[provider].includes(savedModel))) {
           setModel(savedModel);
         } else if (AVAILABLE_MODELS[provider]) {
           setModel(AVAILABLE_MODELS[provider][0]);
@@ -207,12 +222,74 @@ export default function ChatbotApp() {
     }
   }, [darkMode]);
 
+  // Abort the pending reply and tell the backend to stop the provider call
+  const cancelInflight = useCallback(() => {
+    const inflight = inflightRef.current;
+    if (!inflight) return;
+    inflightRef.current = null;
+    // Over the socket the abort itself sends a cancel frame
+    inflight.controller.abort();
+    if (inflight.viaSocket) return;
+    fetch(`/api/chat/${inflight.requestId}/cancel`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({}),
+      keepalive: true
+    }).catch((error) => console.error('Failed to cancel chat request:', error));
+  }, []);
+
+  // Cancel anything still in flight when the tab is closed
+  useEffect(() => {
+    window.addEventListener('pagehide', cancelInflight);
+    return () => window.removeEventListener('pagehide', cancelInflight);
+  }, [cancelInflight]);
+
+  // Memoized MessageItem rows for the virtualized list
+  const renderMessage = useCallback((message, index) => (
+    <MessageItem message={message} index={index} darkMode={darkMode} />
+  ), [darkMode]);
+
+  // Prefer the persistent WebSocket channel; fall back to a plain POST. After a
+  // failed handshake connect() rejects immediately until its backoff expires.
+  const sendChatRequest = async (requestBody, onToken, inflight) => {
+    const { signal } = inflight.controller;
+    const chatSocket = chatSocketRef.current;
+    if (chatSocket) {
+      let socketReady = false;
+      try {
+        await chatSocket.connect();
+        socketReady = true;
+      } catch (error) {
+        console.warn('Chat socket unavailable, using HTTP:', error);
+      }
+      if (socketReady) {
+        inflight.viaSocket = true;
+        return chatSocket.chat(requestBody, { onToken, signal });
+      }
+    }
+
+    const response = await fetch('/api/chat', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(requestBody),
+      signal
+    });
+
+    const data = await response.json();
+
+    if (!response.ok) {
+      throw new Error(data.error || 'Failed to get response');
+    }
+    return data;
+  };
+
   const handleSubmit = async (e) => {
     e.preventDefault();
     if (!input.trim() || !apiKey.trim()) return;
 
     const timestamp = Date.now();
     const userMessage = { 
+      id: uuidv4(),
       role: 'user', 
       content: input,
       timestamp
@@ -223,12 +300,18 @@ export default function ChatbotApp() {
     setLoading(true);
     setError(null);
 
+    const inflight = { requestId: uuidv4(), controller: new AbortController(), viaSocket: false };
+    inflightRef.current = inflight;
+
     try {
       const requestBody = {
         messages: newMessages,
         provider,
         model,
-        apiKey
+        apiKey,
+        request_id: inflight.requestId,
+        // Someone is waiting on this reply; scripted callers default to "batch"
+        priority: 'interactive'
       };
 
       // Include session_id if we have one for context continuity
@@ -236,17 +319,25 @@ export default function ChatbotApp() {
         requestBody.session_id = sessionId;
       }
 
-      const response = await fetch('/api/chat', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(requestBody)
-      });
-
-      const data = await response.json();
+      // Stream the reply into a single assistant message as chunks arrive
+      const assistantId = uuidv4();
+      const assistantTimestamp = Date.now();
+      let streamed = '';
+      const onToken = (delta) => {
+        if (inflight.controller.signal.aborted) return;
+        streamed += delta;
+        setMessages(prev => {
+          const last = prev[prev.length - 1];
+          if (last?.id === assistantId) {
+            return [...prev.slice(0, -1), { ...last, content: streamed }];
+          }
+          return [...prev, { id: assistantId, role: 'assistant', content: streamed, timestamp: assistantTimestamp }];
+        });
+      };
 
-      if (!response.ok) {
-        throw new Error(data.error || 'Failed to get response');
-      }
+      const data = await sendChatRequest(requestBody, onToken, inflight);
+      // The chat was cleared while the reply was arriving; don't resurrect it
+      if (inflight.controller.signal.aborted) return;
 
       // Store session_id for context continuity
       if (data.session_id && !sessionId) {
@@ -254,21 +345,35 @@ export default function ChatbotApp() {
       }
 
       const assistantMessage = { 
+        id: assistantId,
         role: 'assistant', 
         content: data.response,
-        timestamp: Date.now()
+        model: data.model,
+        timestamp: assistantTimestamp
       };
-      setMessages(prev => [...prev, assistantMessage]);
+      setMessages(prev => {
+        const last = prev[prev.length - 1];
+        if (last?.id === assistantId) {
+          return [...prev.slice(0, -1), assistantMessage];
+        }
+        return [...prev, assistantMessage];
+      });
     } catch (err) {
+      // A cancelled request belongs to a chat that has already been cleared
+      if (err.name === 'AbortError') return;
       setError(err.message);
       // Remove the user message if there was an error
       setMessages(messages);
     } finally {
+      if (inflightRef.current === inflight) {
+        inflightRef.current = null;
+      }
       setLoading(false);
     }
   };
 
   const clearChat = () => {
+    cancelInflight();
     setMessages([]);
     setError(null);
     setSessionId(null); // Reset session for new conversation
@@ -357,6 +462,7 @@ export default function ChatbotApp() {
                   <SelectValue />
                 </SelectTrigger>
                 <SelectContent>
+                  <SelectItem value="auto" className="text-sm">Auto (fastest available)</SelectItem>
                   {availableModels[provider]?.map(m => (
                     <SelectItem key={m} value={m} className="text-sm">{m}</SelectItem>
                   ))}
@@ -443,9 +549,9 @@ export default function ChatbotApp() {
 
         {/* Chat Messages Area - Responsive */}
         <div className="flex-1 overflow-hidden">
-          <ScrollArea className="h-full">
-            <div className="max-w-4xl mx-auto p-3 sm:p-4 lg:p-6">
-              {messages.length === 0 ? (
+          {messages.length === 0 ? (
+            <div className="h-full overflow-y-auto">
+              <div className="max-w-4xl mx-auto p-3 sm:p-4 lg:p-6">
                 <div className="flex flex-col items-center justify-center h-full text-center py-10 sm:py-20">
                   <div className="bg-gradient-to-br from-blue-500 to-purple-600 w-12 h-12 sm:w-16 sm:h-16 rounded-full flex items-center justify-center mb-4 sm:mb-6">
                     <Bot className="h-6 w-6 sm:h-8 sm:w-8 text-white" />
@@ -458,41 +564,36 @@ export default function ChatbotApp() {
                     Choose your preferred model and start chatting!
                   </p>
                 </div>
-              ) : (
-                <div className="space-y-4 sm:space-y-6 pb-4">
-                  {/* Use memoized MessageItem components for better performance */}
-                  {messages.map((message, index) => (
-                    <MessageItem 
-                      key={`${message.timestamp || index}-${index}`} 
-                      message={message} 
-                      index={index} 
-                      darkMode={darkMode} 
-                    />
-                  ))}
-
-                  {loading && (
-                    <div className="flex gap-3 sm:gap-4 justify-start">
-                      <div className="flex-shrink-0 w-8 h-8 bg-gradient-to-br from-blue-500 to-purple-600 rounded-full flex items-center justify-center">
-                        <Bot className="h-5 w-5 text-white" />
-                      </div>
-                      <div className="bg-gray-100 dark:bg-gray-700 p-3 sm:p-4 rounded-2xl rounded-bl-md">
-                        <div className="flex items-center gap-2">
-                          <div className="flex space-x-1">
-                            <div className="w-2 h-2 bg-gray-500 rounded-full animate-bounce"></div>
-                            <div className="w-2 h-2 bg-gray-500 rounded-full animate-bounce" style={{animationDelay: '0.1s'}}></div>
-                            <div className="w-2 h-2 bg-gray-500 rounded-full animate-bounce" style={{animationDelay: '0.2s'}}></div>
-                          </div>
-                          <span className="text-sm text-gray-500 dark:text-gray-400">Thinking...</span>
-                        </div>
+              </div>
+            </div>
+          ) : (
+            // Only messages near the viewport are mounted, so long chats stay responsive
+            <VirtualMessageList
+              items={messages}
+              getKey={getMessageKey}
+              renderItem={renderMessage}
+              className="h-full overflow-y-auto"
+              innerClassName="max-w-4xl mx-auto p-3 sm:p-4 lg:p-6"
+              rowClassName="pb-4 sm:pb-6"
+              footer={loading && messages[messages.length - 1]?.role !== 'assistant' && (
+                <div className="flex gap-3 sm:gap-4 justify-start pb-4">
+                  <div className="flex-shrink-0 w-8 h-8 bg-gradient-to-br from-blue-500 to-purple-600 rounded-full flex items-center justify-center">
+                    <Bot className="h-5 w-5 text-white" />
+                  </div>
+                  <div className="bg-gray-100 dark:bg-gray-700 p-3 sm:p-4 rounded-2xl rounded-bl-md">
+                    <div className="flex items-center gap-2">
+                      <div className="flex space-x-1">
+                        <div className="w-2 h-2 bg-gray-500 rounded-full animate-bounce"></div>
+                        <div className="w-2 h-2 bg-gray-500 rounded-full animate-bounce" style={{animationDelay: '0.1s'}}></div>
+                        <div className="w-2 h-2 bg-gray-500 rounded-full animate-bounce" style={{animationDelay: '0.2s'}}></div>
                       </div>
+                      <span className="text-sm text-gray-500 dark:text-gray-400">Thinking...</span>
                     </div>
-                  )}
-
-                  <div ref={messagesEndRef} />
+                  </div>
                 </div>
               )}
-            </div>
-          </ScrollArea>
+            />
+          )}
         </div>
 
         {/* Responsive Error Display */}
@@ -0,0 +1,273 @@
+"""Export chat turns to columnar files for offline analytics.
+
+Each stored chat record holds the whole conversation so far, so exporting the
+`messages` arrays duplicates every earlier turn. This exports only the two turns
+each record adds (the new user message and the assistant response) as flat rows:
+
+    session_id, chat_id, turn_index, role, provider, model, timestamp,
+    content_length, tokens_estimate
+
+Content lengths are computed inside MongoDB, so message text is never loaded
+and memory stays bounded by BATCH_ROWS regardless of dataset size.
+
+Usage (from the backend directory):
+    python export_turns.py --out exports/turns [--format parquet|arrow] [--full]
+
+Files are partitioned as <out>/date=YYYY-MM-DD/part-<run>-<id>.<ext>, and
+<out>/_checkpoint.json records the last exported chat so the next run only
+exports newer ones. Chats from the last SETTLE_SECONDS are left for the next run.
+"""
+
+import argparse
+import json
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+BATCH_ROWS = 50000  # rows held in memory before a batch is written
+CURSOR_BATCH_SIZE = 1000
+CHECKPOINT_FILE = "_checkpoint.json"
+# Chat timestamps are taken before the insert runs, so a record can land after a
+# newer one; only export records older than this so the checkpoint never passes them
+SETTLE_SECONDS = float(os.getenv("EXPORT_SETTLE_SECONDS", "120"))
+FORMATS = {"parquet": "parquet", "arrow": "arrow"}  # format -> file extension
+
+TURN_SCHEMA = pa.schema([
+    ("session_id", pa.string()),
+    ("chat_id", pa.string()),
+    ("turn_index", pa.int32()),
+    ("role", pa.string()),
+    ("provider", pa.string()),
+    ("model", pa.string()),
+    ("timestamp", pa.timestamp("ms", tz="UTC")),
+    ("content_length", pa.int32()),
+    # The provider client doesn't report usage, so this is ~4 characters per token
+    ("tokens_estimate", pa.int32()),
+])
+
+def estimate_tokens(length: int) -> int:
+    return (length + 3) // 4
+
+def turn_pipeline(since: dict = None, until: datetime = None) -> list:
+    """Aggregation yielding one small document per chat record, oldest first"""
+    match = {}
+    if since:
+        match["$or"] = [
+            {"timestamp": {"$gt": since["timestamp"]}},
+            {"timestamp": since["timestamp"], "_id": {"$gt": since["_id"]}},
+        ]
+    if until:
+        match["timestamp"] = {"$lt": until}
+    return [
+        {"$match": match},
+        {"$sort": {"timestamp": 1, "_id": 1}},
+        {"$project": {
+            "session_id": 1,
+            "provider": 1,
+            "model": 1,
+            "timestamp": 1,
+            "history_length": {"$size": {"$ifNull": ["$messages", []]}},
+            "user_role": {"$ifNull": [{"$arrayElemAt": ["$messages.role", -1]}, "user"]},
+            "user_length": {"$strLenCP": {"$ifNull": [{"$arrayElemAt": ["$messages.content", -1]}, ""]}},
+            "response_length": {"$strLenCP": {"$ifNull": ["$response", ""]}},
+        }},
+    ]
+
+def _empty_columns() -> dict:
+    return {name: [] for name in TURN_SCHEMA.names}
+
+def _append_turn(columns: dict, doc: dict, turn_index: int, role: str, length: int):
+    columns["session_id"].append(doc.get("session_id"))
+    columns["chat_id"].append(str(doc["_id"]))
+    columns["turn_index"].append(turn_index)
+    columns["role"].append(role)
+    columns["provider"].append(doc.get("provider"))
+    columns["model"].append(doc.get("model"))
+    columns["timestamp"].append(doc["timestamp"].replace(tzinfo=timezone.utc))
+    columns["content_length"].append(length)
+    columns["tokens_estimate"].append(estimate_tokens(length))
+
+def iter_turn_batches(collection, since: dict = None, batch_rows: int = BATCH_ROWS, until: datetime = None):
+    """Yield (date, record batch, checkpoint) in timestamp order.
+
+    A batch never spans two dates, so each one belongs to a single partition.
+    The checkpoint is the last chat record included so far.
+    """
+    columns = _empty_columns()
+    current_date = None
+    checkpoint = None
+
+    cursor = collection.aggregate(turn_pipeline(since, until), allowDiskUse=True, batchSize=CURSOR_BATCH_SIZE)
+    for doc in cursor:
+        date = doc["timestamp"].strftime("%Y-%m-%d")
+        if columns["chat_id"] and (date != current_date or len(columns["chat_id"]) >= batch_rows):
+            yield current_date, pa.RecordBatch.from_pydict(columns, schema=TURN_SCHEMA), checkpoint
+            columns = _empty_columns()
+        current_date = date
+
+        # The record adds the last user message and the response to the conversation
+        history_length = doc.get("history_length", 0)
+        _append_turn(columns, doc, max(history_length - 1, 0), doc.get("user_role", "user"), doc.get("user_length", 0))
+        _append_turn(columns, doc, history_length, "assistant", doc.get("response_length", 0))
+        checkpoint = {"timestamp": doc["timestamp"], "_id": doc["_id"]}
+
+    if columns["chat_id"]:
+        yield current_date, pa.RecordBatch.from_pydict(columns, schema=TURN_SCHEMA), checkpoint
+
+def open_writer(sink, format: str):
+    if format == "parquet":
+        return pq.ParquetWriter(sink, TURN_SCHEMA, compression="zstd")
+    return pa.ipc.new_file(sink, TURN_SCHEMA)
+
+def write_batch(writer, batch: pa.RecordBatch):
+    if isinstance(writer, pq.ParquetWriter):
+        writer.write_table(pa.Table.from_batches([batch]))
+    else:
+        writer.write_batch(batch)
+
+def load_checkpoint(out_dir: str) -> dict:
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        data = json.load(f)
+    return {"timestamp": datetime.fromisoformat(data["timestamp"]), "_id": data["_id"]}
+
+def save_checkpoint(out_dir: str, checkpoint: dict):
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"timestamp": checkpoint["timestamp"].isoformat(), "_id": str(checkpoint["_id"])}, f)
+    os.replace(tmp_path, path)
+
+def export_to_directory(collection, out_dir: str, format: str = "parquet", full: bool = False) -> dict:
+    """Write turns newer than the checkpoint into date partitions under out_dir.
+
+    Files are written under temporary names and only renamed, and the
+    checkpoint advanced, once the whole run succeeds.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported format {format}")
+    os.makedirs(out_dir, exist_ok=True)
+    since = None if full else load_checkpoint(out_dir)
+    now = datetime.utcnow()
+    until = now - timedelta(seconds=SETTLE_SECONDS)
+    # The random suffix keeps runs started in the same second from replacing each other's files
+    run_id = f"{now.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    written = []  # (temporary path, final path)
+    writer = None
+    current_date = None
+    checkpoint = None
+    rows = 0
+    try:
+        for date, batch, checkpoint in iter_turn_batches(collection, since, until=until):
+            if date != current_date:
+                if writer is not None:
+                    writer.close()
+                partition = os.path.join(out_dir, f"date={date}")
+                os.makedirs(partition, exist_ok=True)
+                final_path = os.path.join(partition, f"part-{run_id}.{FORMATS[format]}")
+                written.append((final_path + ".tmp", final_path))
+                writer = open_writer(written[-1][0], format)
+                current_date = date
+            write_batch(writer, batch)
+            rows += batch.num_rows
+        if writer is not None:
+            writer.close()
+            writer = None
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        for tmp_path, _ in written:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    for tmp_path, final_path in written:
+        os.replace(tmp_path, final_path)
+    if checkpoint is not None:
+        save_checkpoint(out_dir, checkpoint)
+
+    return {
+        "rows": rows,
+        "files": [final_path for _, final_path in written],
+        "since": since["timestamp"].isoformat() if since else None,
+        "checkpoint": checkpoint["timestamp"].isoformat() if checkpoint else None,
+        "until": until.isoformat(),
+    }
+
+class _ChunkSink:
+    """Write-only file object whose contents are drained as the writer produces them"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_turns(collection, since: dict = None, format: str = "arrow"):
+    """Yield an Arrow IPC stream or Parquet file as byte chunks, one batch at a time"""
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported format {format}")
+    sink = _ChunkSink()
+    if format == "parquet":
+        writer = pq.ParquetWriter(sink, TURN_SCHEMA, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, TURN_SCHEMA)
+    for _, batch, _ in iter_turn_batches(collection, since):
+        write_batch(writer, batch)
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+    writer.close()
+    yield sink.drain()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export chat turns to partitioned Parquet/Arrow files")
+    parser.add_argument("--out", default="exports/turns", help="Output directory")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    parser.add_argument("--full", action="store_true", help="Ignore the checkpoint and export everything")
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv("MONGO_URL", "mongodb://localhost:27017/chatbot_db"))
+    chats_collection = client.chatbot_db.chats
+    # Lets the incremental $match/$sort use an index instead of scanning
+    chats_collection.create_index([("timestamp", 1), ("_id", 1)])
+
+    summary = export_to_directory(chats_collection, args.out, args.format, args.full)
+    print(f"Exported {summary['rows']} turns into {len(summary['files'])} file(s); checkpoint {summary['checkpoint']}")
+
+if __name__ == "__main__":
+    main()
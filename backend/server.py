@@ -1,13 +1,26 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ValidationError
 from typing import List, Dict, Any
 import os
+import sys
+import hmac
+import heapq
+import hashlib
+import itertools
+import json
+import time
 import uuid
+import threading
+import weakref
 from dotenv import load_dotenv
 import pymongo
 from pymongo import MongoClient
-from datetime import datetime
+from datetime import datetime, timezone
+from collections import Counter, deque
 import asyncio
 
 # Load environment variables
@@ -16,6 +29,8 @@ load_dotenv()
 # Import emergentintegrations
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 
+from export_turns import stream_turns, FORMATS as EXPORT_FORMATS
+
 app = FastAPI(title="AI Chatbot API", version="1.0.0")
 
 # CORS middleware
@@ -88,6 +103,92 @@ AVAILABLE_MODELS = {
     ]
 }
 
+SYSTEM_MESSAGE = "You are a helpful AI assistant. Provide clear, accurate, and comprehensive responses. Always complete your responses fully without cutting off mid-sentence. Use markdown formatting when appropriate for better readability."
+
+# WebSocket settings
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))  # seconds between server pings
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))  # close if the client is silent this long
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "8"))  # concurrent chat streams per connection
+WS_CHUNK_SIZE = 64  # characters per token frame
+
+# How often an in-flight /api/chat request checks whether its client went away
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# In-flight chat turns by client request id, so they can be cancelled
+inflight_chats: Dict[str, asyncio.Task] = {}
+
+# Why a chat task was cancelled; complete_chat counts it if the cancel interrupted the turn
+cancel_reasons = weakref.WeakKeyDictionary()
+
+# Profiling settings - admin endpoints are disabled unless ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_MAX_SECONDS = 60
+PROFILE_MIN_INTERVAL = 0.001  # never sample faster than 1kHz
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000
+LOOP_LAG_CHECK_INTERVAL = 0.05
+
+# "auto" model routing
+AUTO_MODEL = "auto"
+ROUTER_DEFAULT_POLICY = os.getenv("ROUTER_POLICY", "fastest")
+ROUTER_LATENCY_SLO = float(os.getenv("ROUTER_LATENCY_SLO", "8"))  # seconds
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+ROUTER_MAX_ERROR_RATE = 0.5  # skip models failing more often than this
+ROUTER_ERROR_HALF_LIFE = float(os.getenv("ROUTER_ERROR_HALF_LIFE", "60"))  # seconds for an error rate to halve
+ROUTER_LATENCY_HALF_LIFE = float(os.getenv("ROUTER_LATENCY_HALF_LIFE", "900"))  # seconds for latency to drift halfway back to the prior
+ROUTER_LONG_PROMPT_CHARS = 4000  # prompts this long need a mid-tier model or better
+ROUTER_HUGE_PROMPT_CHARS = 16000  # ... and these need a top-tier model
+ROUTER_POLICIES = ("fastest", "cheapest", "quality")
+
+# Models the router may pick, with relative cost (1 = cheapest) and quality
+# (1-3) tiers. Other models in AVAILABLE_MODELS stay available by name only.
+MODEL_PROFILES = {
+    "openai": {
+        "gpt-4.1-nano": {"cost": 1, "quality": 1},
+        "gpt-4o-mini": {"cost": 1, "quality": 2},
+        "gpt-4.1-mini": {"cost": 2, "quality": 2},
+        "gpt-5-mini": {"cost": 2, "quality": 3},
+        "gpt-4o": {"cost": 3, "quality": 3},
+        "gpt-4.1": {"cost": 3, "quality": 3},
+    },
+    "anthropic": {
+        "claude-3-5-haiku-20241022": {"cost": 1, "quality": 2},
+        "claude-3-5-sonnet-20241022": {"cost": 3, "quality": 3},
+        "claude-4-sonnet-20250514": {"cost": 3, "quality": 3},
+    },
+    "gemini": {
+        "gemini-2.0-flash-lite": {"cost": 1, "quality": 1},
+        "gemini-2.0-flash": {"cost": 1, "quality": 2},
+        "gemini-2.5-flash": {"cost": 2, "quality": 2},
+        "gemini-2.5-pro": {"cost": 3, "quality": 3},
+    },
+}
+
+# Latency assumed for a model before we have observed it, by quality tier
+ROUTER_PRIOR_LATENCY = {1: 2.0, 2: 4.0, 3: 8.0}
+
+# Provider call scheduling - weighted fair queuing per priority class and API key
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "16"))  # provider calls in flight
+SCHEDULER_MAX_QUEUE_PER_KEY = int(os.getenv("SCHEDULER_MAX_QUEUE_PER_KEY", "50"))
+SCHEDULER_CLASSES = {
+    # weight: share of dispatches relative to other classes
+    # max_queue: requests allowed to wait in this class before returning 429
+    # deadline: default seconds a request may take end to end
+    "interactive": {"weight": float(os.getenv("SCHEDULER_INTERACTIVE_WEIGHT", "4")), "max_queue": 200, "deadline": 60.0},
+    "batch": {"weight": float(os.getenv("SCHEDULER_BATCH_WEIGHT", "1")), "max_queue": 1000, "deadline": 600.0},
+}
+
+# Cancellation counters exposed on /api/metrics
+CHAT_METRICS: Dict[str, float] = {
+    "chat_requests": 0,
+    "chat_rejected": 0,  # turned away by the scheduler (bad priority, queue full, deadline)
+    "chat_completed": 0,
+    "chat_cancelled": 0,
+    "chat_cancelled_by_client": 0,  # cancel endpoint or websocket cancel frame
+    "chat_cancelled_by_disconnect": 0,  # tab closed / socket dropped
+    "chat_wasted_responses": 0,  # provider answered but nobody was left to read it (the record is still saved)
+    "chat_cancelled_provider_seconds": 0.0,  # provider time spent before cancellation
+}
+
 class ChatMessage(BaseModel):
     role: str
     content: str
@@ -98,10 +199,16 @@ class ChatRequest(BaseModel):
     model: str = "gpt-4o-mini"
     apiKey: str
     session_id: str = None  # Optional session ID for context
+    request_id: str = None  # Optional client-chosen ID used to cancel the request
+    routing_policy: str = None  # Policy for model="auto"; defaults to ROUTER_POLICY
+    priority: str = "batch"  # Scheduling class; the web UI sends "interactive", scripts default to "batch"
+    deadline_ms: int = None  # Give up if the answer cannot arrive within this many ms
 
 class ChatResponse(BaseModel):
     response: str
     session_id: str
+    provider: str = None
+    model: str = None
 
 class ModelsResponse(BaseModel):
     models: Dict[str, List[str]]
@@ -115,75 +222,821 @@ async def get_models():
     """Get all available models for each provider"""
     return ModelsResponse(models=AVAILABLE_MODELS)
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    try:
-        # Validate provider and model
-        if request.provider not in AVAILABLE_MODELS:
-            raise HTTPException(status_code=400, detail=f"Provider {request.provider} not supported")
-        
-        if request.model not in AVAILABLE_MODELS[request.provider]:
-            # Use first available model if requested model not found
-            print(f"Model {request.model} not found for {request.provider}. Using default.")
-            request.model = AVAILABLE_MODELS[request.provider][0]
-
-        # Use existing session ID or generate new one
-        session_id = request.session_id or str(uuid.uuid4())
-        
-        # Create LLM chat instance with better configuration
-        chat = LlmChat(
-            api_key=request.apiKey,
-            session_id=session_id,
-            system_message="You are a helpful AI assistant. Provide clear, accurate, and comprehensive responses. Always complete your responses fully without cutting off mid-sentence. Use markdown formatting when appropriate for better readability."
-        )
-        
-        # Configure the model
-        chat.with_model(request.provider, request.model)
-        
-        # Get the last user message for the current request
-        last_user_message = request.messages[-1]
-        if last_user_message.role != "user":
-            raise HTTPException(status_code=400, detail="Last message must be from user")
-        
-        # If we have conversation history and this is continuing a session,
-        # we need to send all messages in the correct format
-        if len(request.messages) > 1:
-            # Create a comprehensive conversation context by building the full conversation
-            conversation_text = ""
-            for i, msg in enumerate(request.messages[:-1]):
-                if msg.role == "user":
-                    conversation_text += f"User: {msg.content}\n\n"
-                elif msg.role == "assistant":
-                    conversation_text += f"Assistant: {msg.content}\n\n"
-            
-            # Add context to the current user message
-            current_message = f"Previous conversation:\n{conversation_text}Current question: {last_user_message.content}"
-            user_message = UserMessage(text=current_message)
+def resolve_model(provider: str, model: str) -> str:
+    """Validate the provider and fall back to its first model if needed"""
+    if provider not in AVAILABLE_MODELS:
+        raise HTTPException(status_code=400, detail=f"Provider {provider} not supported")
+
+    if model not in AVAILABLE_MODELS[provider]:
+        # Use first available model if requested model not found
+        print(f"Model {model} not found for {provider}. Using default.")
+        return AVAILABLE_MODELS[provider][0]
+    return model
+
+# Failures that say something about the model rather than the caller's key or request
+PROVIDER_FAILURE_MARKERS = (
+    "timeout", "timed out", "ratelimit", "rate limit", "overloaded", "serviceunavailable",
+    "service unavailable", "internalserver", "internal server", "apiconnection", "bad gateway",
+)
+
+def is_provider_failure(error: BaseException) -> bool:
+    """Whether a failed provider call should count against the model's error rate"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    # The provider client mostly re-raises with the upstream error folded into the message
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in PROVIDER_FAILURE_MARKERS)
+
+class ModelRouter:
+    """Picks a model for "auto" requests from live EWMA latency/error stats.
+
+    Stats start from the prior for the model's tier. Without new samples,
+    error rates decay toward zero and latency drifts back toward the prior,
+    so a model skipped for failing or one slow call comes back into rotation
+    and gets measured again.
+    """
+
+    def __init__(self, alpha: float, error_half_life: float = ROUTER_ERROR_HALF_LIFE,
+                 latency_half_life: float = ROUTER_LATENCY_HALF_LIFE):
+        self.alpha = alpha
+        self.error_half_life = error_half_life
+        self.latency_half_life = latency_half_life
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self.decisions = deque(maxlen=50)
+
+    def prior(self, provider: str, model: str) -> Dict[str, Any]:
+        quality = MODEL_PROFILES.get(provider, {}).get(model, {}).get("quality", 2)
+        return {"latency": ROUTER_PRIOR_LATENCY[quality], "error_rate": 0.0, "samples": 0, "errors": 0}
+
+    def decay(self, stats: Dict[str, Any], now: float) -> float:
+        """Error rate as of now, halving every error_half_life seconds"""
+        elapsed = now - stats.get("updated", now)
+        return stats["error_rate"] * 0.5 ** (elapsed / self.error_half_life)
+
+    def decay_latency(self, stats: Dict[str, Any], prior: float, now: float) -> float:
+        """Latency as of now, closing half the gap to the prior every latency_half_life seconds"""
+        elapsed = now - stats.get("updated", now)
+        return prior + (stats["latency"] - prior) * 0.5 ** (elapsed / self.latency_half_life)
+
+    def record(self, provider: str, model: str, latency: float, error: bool = False):
+        key = f"{provider}/{model}"
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = self.prior(provider, model)
+        now = time.monotonic()
+        stats["latency"] = self.decay_latency(stats, self.prior(provider, model)["latency"], now)
+        stats["error_rate"] = self.decay(stats, now)
+        stats["error_rate"] += self.alpha * ((1.0 if error else 0.0) - stats["error_rate"])
+        stats["updated"] = now
+        if error:
+            # A failure's latency says nothing about how fast the model answers
+            stats["errors"] += 1
         else:
-            user_message = UserMessage(text=last_user_message.content)
-        
-        # Send message and get response
-        response = await chat.send_message(user_message)
-        
-        # Store conversation in database
-        chat_record = {
-            "_id": str(uuid.uuid4()),
-            "session_id": session_id,
-            "provider": request.provider,
-            "model": request.model,
-            "messages": [msg.dict() for msg in request.messages],
-            "response": response,
-            "timestamp": datetime.utcnow(),
-            "api_key_used": "emergent_universal" if request.apiKey.startswith("sk-emergent") else "custom"
+            stats["latency"] += self.alpha * (latency - stats["latency"])
+            stats["samples"] += 1
+
+    def expected(self, provider: str, model: str) -> Dict[str, float]:
+        stats = self.stats.get(f"{provider}/{model}")
+        if stats is None:
+            return self.prior(provider, model)
+        now = time.monotonic()
+        return {
+            "latency": self.decay_latency(stats, self.prior(provider, model)["latency"], now),
+            "error_rate": self.decay(stats, now),
         }
-        
-        chats_collection.insert_one(chat_record)
-        
-        return ChatResponse(response=response, session_id=session_id)
-        
+
+    def route(self, provider: str, prompt_chars: int, policy: str) -> Dict[str, Any]:
+        providers = list(MODEL_PROFILES) if provider == AUTO_MODEL else [provider]
+        candidates = []
+        for name in providers:
+            for model, profile in MODEL_PROFILES.get(name, {}).items():
+                candidates.append({"provider": name, "model": model, **profile, **self.expected(name, model)})
+        if not candidates:
+            raise HTTPException(status_code=400, detail=f"Provider {provider} has no models available for auto routing")
+
+        # Longer prompts need a more capable model
+        min_quality = 1
+        if prompt_chars >= ROUTER_HUGE_PROMPT_CHARS:
+            min_quality = 3
+        elif prompt_chars >= ROUTER_LONG_PROMPT_CHARS:
+            min_quality = 2
+        eligible = [c for c in candidates if c["quality"] >= min_quality] or candidates
+
+        # Avoid models that are currently failing, unless they all are
+        eligible = [c for c in eligible if c["error_rate"] <= ROUTER_MAX_ERROR_RATE] or eligible
+
+        within_slo = [c for c in eligible if c["latency"] <= ROUTER_LATENCY_SLO]
+        if policy == "cheapest" and within_slo:
+            choice = min(within_slo, key=lambda c: (c["cost"], c["latency"]))
+        elif policy == "quality" and within_slo:
+            choice = min(within_slo, key=lambda c: (-c["quality"], c["latency"]))
+        else:
+            choice = min(eligible, key=lambda c: c["latency"])
+
+        self.decisions.append({
+            "timestamp": datetime.utcnow().isoformat(),
+            "policy": policy,
+            "requested_provider": provider,
+            "prompt_chars": prompt_chars,
+            "provider": choice["provider"],
+            "model": choice["model"],
+            "expected_latency": round(choice["latency"], 3),
+            "candidates": len(eligible),
+        })
+        return choice
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "default_policy": ROUTER_DEFAULT_POLICY,
+            "policies": list(ROUTER_POLICIES),
+            "latency_slo": ROUTER_LATENCY_SLO,
+            "ewma_alpha": self.alpha,
+            "error_half_life": self.error_half_life,
+            "latency_half_life": self.latency_half_life,
+            "stats": {
+                key: {**{k: v for k, v in stats.items() if k != "updated"}, **self.expected(*key.split("/", 1))}
+                for key, stats in self.stats.items()
+            },
+            "decisions": list(self.decisions),
+        }
+
+model_router = ModelRouter(ROUTER_EWMA_ALPHA)
+
+def resolve_request(request: ChatRequest):
+    """Route "auto" requests to a concrete model, then validate it"""
+    if request.provider == AUTO_MODEL or request.model == AUTO_MODEL:
+        policy = request.routing_policy or ROUTER_DEFAULT_POLICY
+        if policy not in ROUTER_POLICIES:
+            raise HTTPException(status_code=400, detail=f"Routing policy {policy} not supported")
+        prompt_chars = sum(len(msg.content) for msg in request.messages)
+        choice = model_router.route(request.provider, prompt_chars, policy)
+        request.provider, request.model = choice["provider"], choice["model"]
+    request.model = resolve_model(request.provider, request.model)
+
+class QueuedCall:
+    """A chat turn waiting for a provider slot"""
+
+    def __init__(self, priority: str, flow: tuple, deadline: float, expected_service: float, finish: float):
+        self.priority = priority
+        self.flow = flow
+        self.deadline = deadline
+        self.expected_service = expected_service
+        self.finish = finish
+        self.enqueued = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+        self.dead = False
+
+class ChatScheduler:
+    """Weighted fair queuing of provider calls.
+
+    Each (priority class, API-key hash) pair is a flow. A flow's calls are
+    tagged with virtual finish times advancing by 1/weight of its class, and
+    the smallest tag is dispatched next, so one key flooding the batch class
+    cannot starve interactive users or other keys.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.active = 0
+        self.queue = []  # heap of (finish tag, seq, QueuedCall)
+        self.seq = itertools.count()
+        self.virtual_time = 0.0
+        self.flow_finish: Dict[tuple, float] = {}
+        self.queued_by_flow = Counter()
+        self.queued_by_class = Counter()
+        self.queued_by_key = Counter()
+        self.stats = {
+            name: {"dispatched": 0, "rejected": 0, "dropped": 0, "waits": deque(maxlen=1000), "max_wait": 0.0}
+            for name in SCHEDULER_CLASSES
+        }
+
+    @asynccontextmanager
+    async def slot(self, priority: str, key: str, deadline_ms: int = None, expected_service: float = 0.0):
+        """Hold a provider slot for the duration of the block; yields the monotonic deadline"""
+        if priority not in SCHEDULER_CLASSES:
+            raise HTTPException(status_code=400, detail=f"Priority {priority} not supported")
+        deadline_s = deadline_ms / 1000 if deadline_ms else SCHEDULER_CLASSES[priority]["deadline"]
+        deadline = time.monotonic() + deadline_s
+        await self.acquire(priority, key, deadline, expected_service)
+        try:
+            yield deadline
+        finally:
+            self.release()
+
+    async def acquire(self, priority: str, key: str, deadline: float, expected_service: float):
+        if self.active < self.concurrency and not self.queue:
+            if time.monotonic() + expected_service > deadline:
+                self.stats[priority]["dropped"] += 1
+                raise HTTPException(status_code=504, detail="Deadline cannot be met")
+            self.active += 1
+            self.record_wait(priority, 0.0)
+            return
+
+        if self.queued_by_class[priority] >= SCHEDULER_CLASSES[priority]["max_queue"] \
+                or self.queued_by_key[key] >= SCHEDULER_MAX_QUEUE_PER_KEY:
+            self.stats[priority]["rejected"] += 1
+            raise HTTPException(status_code=429, detail="Too many queued requests, try again later")
+
+        flow = (priority, key)
+        start = max(self.virtual_time, self.flow_finish.get(flow, 0.0))
+        finish = start + 1.0 / SCHEDULER_CLASSES[priority]["weight"]
+        self.flow_finish[flow] = finish
+        call = QueuedCall(priority, flow, deadline, expected_service, finish)
+        heapq.heappush(self.queue, (finish, next(self.seq), call))
+        self.queued_by_flow[flow] += 1
+        self.queued_by_class[priority] += 1
+        self.queued_by_key[key] += 1
+        self.dispatch()
+
+        try:
+            done, _ = await asyncio.wait({call.future}, timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.CancelledError:
+            if call.future.done() and not call.future.cancelled() and call.future.exception() is None:
+                # Slot was handed to us as we were cancelled; pass it on
+                self.release()
+            else:
+                self.forget(call)
+            raise
+        if not done:
+            self.forget(call)
+            self.stats[priority]["dropped"] += 1
+            raise HTTPException(status_code=504, detail="Deadline exceeded while queued")
+        call.future.result()
+
+    def forget(self, call: QueuedCall):
+        """Take a call out of the queue counters; the heap entry is skipped later"""
+        if call.dead:
+            return
+        call.dead = True
+        self.queued_by_flow[call.flow] -= 1
+        self.queued_by_class[call.priority] -= 1
+        self.queued_by_key[call.flow[1]] -= 1
+        if not self.queued_by_flow[call.flow]:
+            del self.queued_by_flow[call.flow]
+        if not self.queued_by_key[call.flow[1]]:
+            del self.queued_by_key[call.flow[1]]
+
+    def release(self):
+        self.active -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        while self.queue and self.active < self.concurrency:
+            finish, _, call = heapq.heappop(self.queue)
+            if call.dead:
+                continue
+            self.forget(call)
+            self.virtual_time = max(self.virtual_time, finish - 1.0 / SCHEDULER_CLASSES[call.priority]["weight"])
+
+            now = time.monotonic()
+            if now + call.expected_service > call.deadline:
+                # Would miss its deadline anyway; don't spend a provider call on it
+                self.stats[call.priority]["dropped"] += 1
+                call.future.set_exception(HTTPException(status_code=504, detail="Deadline cannot be met"))
+                continue
+
+            self.active += 1
+            self.record_wait(call.priority, now - call.enqueued)
+            call.future.set_result(None)
+
+        # Idle flows no longer need their finish tags
+        for flow in [f for f, tag in self.flow_finish.items() if tag <= self.virtual_time and f not in self.queued_by_flow]:
+            del self.flow_finish[flow]
+
+    def record_wait(self, priority: str, wait: float):
+        stats = self.stats[priority]
+        stats["dispatched"] += 1
+        stats["waits"].append(wait)
+        stats["max_wait"] = max(stats["max_wait"], wait)
+
+    def snapshot(self) -> Dict[str, Any]:
+        classes = {}
+        for name, stats in self.stats.items():
+            waits = sorted(stats["waits"])
+            percentile = lambda q: round(waits[min(len(waits) - 1, int(q * len(waits)))] * 1000, 1) if waits else 0.0
+            classes[name] = {
+                "weight": SCHEDULER_CLASSES[name]["weight"],
+                "max_queue": SCHEDULER_CLASSES[name]["max_queue"],
+                "queued": self.queued_by_class[name],
+                "dispatched": stats["dispatched"],
+                "rejected": stats["rejected"],
+                "dropped": stats["dropped"],
+                "wait_ms": {
+                    "mean": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+                    "p50": percentile(0.5),
+                    "p95": percentile(0.95),
+                    "p99": percentile(0.99),
+                    "max": round(stats["max_wait"] * 1000, 1),
+                },
+            }
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queued": sum(self.queued_by_class.values()),
+            "active_keys": len(self.queued_by_key),
+            "classes": classes,
+        }
+
+chat_scheduler = ChatScheduler(SCHEDULER_MAX_CONCURRENCY)
+
+def api_key_hash(api_key: str) -> str:
+    """Stable, non-reversible identifier for an API key"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+def build_user_message(messages: List[ChatMessage]) -> UserMessage:
+    """Fold the conversation history into the message sent to the provider"""
+    # Get the last user message for the current request
+    last_user_message = messages[-1]
+    if last_user_message.role != "user":
+        raise HTTPException(status_code=400, detail="Last message must be from user")
+
+    # If we have conversation history and this is continuing a session,
+    # we need to send all messages in the correct format
+    if len(messages) > 1:
+        # Create a comprehensive conversation context by building the full conversation
+        conversation_text = ""
+        for msg in messages[:-1]:
+            if msg.role == "user":
+                conversation_text += f"User: {msg.content}\n\n"
+            elif msg.role == "assistant":
+                conversation_text += f"Assistant: {msg.content}\n\n"
+
+        # Add context to the current user message
+        current_message = f"Previous conversation:\n{conversation_text}Current question: {last_user_message.content}"
+        return UserMessage(text=current_message)
+    return UserMessage(text=last_user_message.content)
+
+async def save_chat_record(request: ChatRequest, session_id: str, response: str):
+    """Store a completed conversation turn without blocking the event loop"""
+    chat_record = {
+        "_id": str(uuid.uuid4()),
+        "session_id": session_id,
+        "provider": request.provider,
+        "model": request.model,
+        "messages": [msg.dict() for msg in request.messages],
+        "response": response,
+        "timestamp": datetime.utcnow(),
+        "api_key_used": "emergent_universal" if request.apiKey.startswith("sk-emergent") else "custom"
+    }
+    await run_in_threadpool(chats_collection.insert_one, chat_record)
+
+async def complete_chat(request: ChatRequest) -> ChatResponse:
+    """Run one chat turn against the provider and persist it"""
+    resolve_request(request)
+
+    # Use existing session ID or generate new one
+    session_id = request.session_id or str(uuid.uuid4())
+
+    # Create LLM chat instance with better configuration
+    chat = LlmChat(
+        api_key=request.apiKey,
+        session_id=session_id,
+        system_message=SYSTEM_MESSAGE
+    )
+
+    # Configure the model
+    chat.with_model(request.provider, request.model)
+
+    user_message = build_user_message(request.messages)
+
+    # Observed latency lets the scheduler drop calls that would miss their deadline
+    observed = model_router.stats.get(f"{request.provider}/{request.model}")
+    expected_service = observed["latency"] if observed and observed["samples"] else 0.0
+
+    CHAT_METRICS["chat_requests"] += 1
+    admitted = False
+    started = None
+    response = None
+    try:
+        async with chat_scheduler.slot(request.priority, api_key_hash(request.apiKey), request.deadline_ms, expected_service) as deadline:
+            admitted = True
+            # Send message and get response, giving up when the deadline passes
+            started = time.monotonic()
+            try:
+                response = await asyncio.wait_for(chat.send_message(user_message), timeout=max(0.0, deadline - started))
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError) and time.monotonic() >= deadline:
+                    # Our deadline ran out; says nothing about the model
+                    chat_scheduler.stats[request.priority]["dropped"] += 1
+                    raise HTTPException(status_code=504, detail="Deadline exceeded waiting for the provider")
+                # Bad keys and bad requests are the caller's problem, not the model's
+                if is_provider_failure(e):
+                    model_router.record(request.provider, request.model, time.monotonic() - started, error=True)
+                raise
+            model_router.record(request.provider, request.model, time.monotonic() - started)
+
+        # Store conversation in database. The answer was paid for, so keep it
+        # even if the client goes away now; the turn still counts as cancelled
+        await asyncio.shield(save_chat_record(request, session_id, response))
+    except HTTPException:
+        if not admitted:
+            CHAT_METRICS["chat_rejected"] += 1
+        raise
+    except asyncio.CancelledError:
+        CHAT_METRICS["chat_cancelled"] += 1
+        reason = cancel_reasons.pop(asyncio.current_task(), None)
+        if reason:
+            CHAT_METRICS[f"chat_cancelled_by_{reason}"] += 1
+        if response is None:
+            if started is not None:
+                CHAT_METRICS["chat_cancelled_provider_seconds"] += time.monotonic() - started
+        else:
+            CHAT_METRICS["chat_wasted_responses"] += 1
+        raise
+    CHAT_METRICS["chat_completed"] += 1
+
+    return ChatResponse(response=response, session_id=session_id, provider=request.provider, model=request.model)
+
+def cancel_chat_task(task: asyncio.Task, reason: str) -> bool:
+    """Cancel an in-flight chat turn, remembering why it was cancelled"""
+    if task.done():
+        return False
+    cancel_reasons.setdefault(task, reason)
+    return task.cancel()
+
+async def watch_disconnect(http_request: Request, task: asyncio.Task):
+    """Cancel the chat turn as soon as the HTTP client goes away"""
+    while not task.done():
+        if await http_request.is_disconnected():
+            cancel_chat_task(task, "disconnect")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, http_request: Request):
+    request_id = request.request_id or str(uuid.uuid4())
+    task = asyncio.create_task(complete_chat(request))
+    inflight_chats[request_id] = task
+    watcher = asyncio.create_task(watch_disconnect(http_request, task))
+    try:
+        await asyncio.wait({task})
+        if task.cancelled():
+            raise HTTPException(status_code=499, detail="Request cancelled")
+        return task.result()
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        watcher.cancel()
+        task.cancel()
+        if inflight_chats.get(request_id) is task:
+            del inflight_chats[request_id]
+
+@app.post("/api/chat/{request_id}/cancel")
+async def cancel_chat(request_id: str):
+    """Cancel an in-flight chat request and its upstream provider call"""
+    task = inflight_chats.get(request_id)
+    cancelled = task is not None and cancel_chat_task(task, "client")
+    return {"request_id": request_id, "cancelled": cancelled}
+
+@app.get("/api/router")
+async def get_router():
+    """Auto-routing policy, per-model EWMA stats and recent decisions"""
+    return model_router.snapshot()
+
+@app.get("/api/scheduler")
+async def get_scheduler():
+    """Scheduler queue depths and per-class queue-wait latency"""
+    return chat_scheduler.snapshot()
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Chat request and cancellation counters"""
+    return {"chat": CHAT_METRICS, "inflight": len(inflight_chats)}
+
+class ChatConnection:
+    """A single /api/ws connection carrying several chat streams.
+
+    Client frames:
+      {"type": "chat", "id": ..., "messages": [...], "provider", "model", "apiKey", "session_id"}
+      {"type": "cancel", "id": ...}
+      {"type": "ping"} / {"type": "pong"}
+
+    Server frames:
+      start, token (with "delta"), done, cancelled, error, ping, pong
+
+    The answer is only sent as token frames; done carries the session and model.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.streams: Dict[str, asyncio.Task] = {}
+        self.send_lock = asyncio.Lock()
+        self.last_seen = time.monotonic()
+
+    async def send(self, frame: Dict[str, Any]):
+        # Streams share one socket, so serialize writes
+        async with self.send_lock:
+            await self.websocket.send_text(json.dumps(frame, default=str))
+
+    async def send_final(self, frame: Dict[str, Any]):
+        """Send a stream's last frame; the socket may already be gone, which is fine"""
+        try:
+            await self.send(frame)
+        except Exception:
+            pass
+
+    async def heartbeat(self):
+        try:
+            while True:
+                await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+                if time.monotonic() - self.last_seen > WS_IDLE_TIMEOUT:
+                    await self.websocket.close(code=1001)
+                    return
+                await self.send({"type": "ping", "ts": time.time()})
+        except (WebSocketDisconnect, RuntimeError):
+            # Socket already gone; the receive loop cleans up
+            return
+
+    async def handle(self, frame: Dict[str, Any]):
+        frame_type = frame.get("type")
+        stream_id = str(frame.get("id") or "")
+
+        if frame_type == "ping":
+            await self.send({"type": "pong", "ts": frame.get("ts")})
+        elif frame_type == "pong":
+            pass
+        elif frame_type == "cancel":
+            task = self.streams.get(stream_id)
+            if task:
+                cancel_chat_task(task, "client")
+        elif frame_type == "chat":
+            if not stream_id:
+                await self.send({"type": "error", "detail": "Chat frames need an id"})
+            elif stream_id in self.streams:
+                await self.send({"type": "error", "id": stream_id, "detail": "Stream id already in use"})
+            elif len(self.streams) >= WS_MAX_STREAMS:
+                await self.send({"type": "error", "id": stream_id, "detail": "Too many concurrent streams"})
+            else:
+                try:
+                    request = ChatRequest(**frame)
+                except ValidationError as e:
+                    await self.send({"type": "error", "id": stream_id, "detail": str(e)})
+                    return
+                self.streams[stream_id] = asyncio.create_task(self.run_stream(stream_id, request))
+        else:
+            await self.send({"type": "error", "id": stream_id or None, "detail": f"Unknown frame type {frame_type}"})
+
+    async def run_stream(self, stream_id: str, request: ChatRequest):
+        if request.request_id:
+            inflight_chats[request.request_id] = asyncio.current_task()
+        try:
+            resolve_request(request)
+            request.session_id = request.session_id or str(uuid.uuid4())
+            await self.send({
+                "type": "start",
+                "id": stream_id,
+                "session_id": request.session_id,
+                "provider": request.provider,
+                "model": request.model,
+            })
+
+            result = await complete_chat(request)
+
+            # The provider client returns the whole answer, so forward it in chunks
+            response = result.response
+            for i in range(0, len(response), WS_CHUNK_SIZE):
+                await self.send({"type": "token", "id": stream_id, "delta": response[i:i + WS_CHUNK_SIZE]})
+
+            await self.send({
+                "type": "done",
+                "id": stream_id,
+                "session_id": result.session_id,
+                "provider": result.provider,
+                "model": result.model,
+            })
+        except asyncio.CancelledError:
+            await self.send_final({"type": "cancelled", "id": stream_id})
+            raise
+        except HTTPException as e:
+            await self.send_final({"type": "error", "id": stream_id, "detail": e.detail})
+        except Exception as e:
+            print(f"Error in websocket stream {stream_id}: {str(e)}")
+            await self.send_final({"type": "error", "id": stream_id, "detail": f"Internal server error: {str(e)}"})
+        finally:
+            self.streams.pop(stream_id, None)
+            if request.request_id and inflight_chats.get(request.request_id) is asyncio.current_task():
+                del inflight_chats[request.request_id]
+
+    async def close(self):
+        tasks = list(self.streams.values())
+        for task in tasks:
+            cancel_chat_task(task, "disconnect")
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+@app.websocket("/api/ws")
+async def chat_socket(websocket: WebSocket):
+    """Persistent chat channel multiplexing several sessions over one connection"""
+    await websocket.accept()
+    connection = ChatConnection(websocket)
+    heartbeat = asyncio.create_task(connection.heartbeat())
+    try:
+        while True:
+            text = await websocket.receive_text()
+            connection.last_seen = time.monotonic()
+            try:
+                frame = json.loads(text)
+            except json.JSONDecodeError:
+                await connection.send({"type": "error", "detail": "Frames must be JSON"})
+                continue
+            if not isinstance(frame, dict):
+                await connection.send({"type": "error", "detail": "Frames must be JSON objects"})
+                continue
+            await connection.handle(frame)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        heartbeat.cancel()
+        await connection.close()
+
+def require_admin(x_admin_token: str = Header(None)):
+    """Gate admin endpoints behind the ADMIN_TOKEN header"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN to enable them")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+def format_stack(frame, current_line: bool = False) -> List[str]:
+    """Root-first list of "function (file:line)" entries for a frame.
+
+    Lines are where each function is defined, so profile samples of the same
+    function aggregate; pass current_line=True for the line each frame is executing.
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        line = frame.f_lineno if current_line else code.co_firstlineno
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{line})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """Sample every thread's stack for a while; returns collapsed stack counts.
+
+    Runs in a worker thread so the event loop keeps serving while it samples.
+    """
+    own_thread = threading.get_ident()
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = [names.get(thread_id, str(thread_id))] + format_stack(frame)
+            counts[";".join(stack)] += 1
+        time.sleep(interval)
+    return counts
+
+profile_lock = threading.Lock()
+
+class LoopLagMonitor:
+    """Records event-loop lag and the stack of whatever blocked the loop.
+
+    A coroutine on the loop beats every LOOP_LAG_CHECK_INTERVAL; a watchdog
+    thread captures the loop thread's stack while a beat is overdue, so the
+    recorded stack is the slow callback itself rather than the code that ran after it.
+    """
+
+    def __init__(self, threshold: float, max_events: int = 100):
+        self.threshold = threshold
+        self.events = deque(maxlen=max_events)
+        self.loop_thread_id = None
+        self.last_beat = None  # set once beat() runs; the watchdog waits for it
+        self.captured_beat = None
+        self.beats = 0
+        self.slow_beats = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    async def beat(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        while True:
+            expected = time.monotonic() + LOOP_LAG_CHECK_INTERVAL
+            await asyncio.sleep(LOOP_LAG_CHECK_INTERVAL)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.last_beat = now
+            self.beats += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.slow_beats += 1
+
+    def watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            last_beat = self.last_beat
+            if last_beat is None:
+                continue
+            stalled = time.monotonic() - last_beat - LOOP_LAG_CHECK_INTERVAL
+            if stalled <= self.threshold or self.captured_beat == last_beat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            # One capture per stall
+            self.captured_beat = last_beat
+            self.events.append({
+                "detected_at": datetime.utcnow().isoformat(),
+                "stalled_ms": round(stalled * 1000, 1),
+                "stack": format_stack(frame, current_line=True),
+            })
+
+    def start(self):
+        self.last_beat = None
+        asyncio.get_running_loop().create_task(self.beat())
+        threading.Thread(target=self.watch, name="loop-lag-monitor", daemon=True).start()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "beats": self.beats,
+            "slow_beats": self.slow_beats,
+            "mean_lag_ms": round(self.total_lag / self.beats * 1000, 2) if self.beats else 0.0,
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "slow_callbacks": list(self.events),
+        }
+
+loop_monitor = LoopLagMonitor(LOOP_LAG_THRESHOLD)
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    loop_monitor.start()
+
+@app.get("/api/admin/profile", dependencies=[Depends(require_admin)])
+async def profile(seconds: float = 10, interval: float = 0.01, format: str = "collapsed"):
+    """Sample all worker threads for N seconds.
+
+    format=collapsed returns "frame;frame;frame count" lines ready for
+    flamegraph.pl / speedscope; format=json returns the same data as a list.
+    """
+    if format not in ("collapsed", "json"):
+        raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'json'")
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    interval = min(max(interval, PROFILE_MIN_INTERVAL), seconds)
+
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        counts = await run_in_threadpool(sample_stacks, seconds, interval)
+    finally:
+        profile_lock.release()
+
+    if format == "json":
+        return {
+            "seconds": seconds,
+            "interval": interval,
+            "stacks": [{"stack": stack.split(";"), "count": count} for stack, count in counts.most_common()],
+        }
+    lines = [f"{stack} {count}" for stack, count in counts.most_common()]
+    return PlainTextResponse("\n".join(lines) + "\n")
+
+@app.get("/api/admin/loop-lag", dependencies=[Depends(require_admin)])
+async def loop_lag():
+    """Event-loop lag stats and stacks of recent slow callbacks"""
+    return loop_monitor.snapshot()
+
+EXPORT_MEDIA_TYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+@app.get("/api/admin/export/turns", dependencies=[Depends(require_admin)])
+async def export_turns(since: str = None, format: str = "arrow"):
+    """Stream conversation turns as an Arrow IPC stream or a Parquet file.
+
+    Pass since (ISO timestamp) to export only turns at or after it. For
+    partitioned, checkpointed exports use `python export_turns.py`.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be 'arrow' or 'parquet'")
+
+    checkpoint = None
+    if since:
+        try:
+            since_dt = datetime.fromisoformat(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="since must be an ISO timestamp")
+        if since_dt.tzinfo is not None:
+            # Chat timestamps are stored as naive UTC
+            since_dt = since_dt.astimezone(timezone.utc).replace(tzinfo=None)
+        checkpoint = {"timestamp": since_dt, "_id": ""}
+
+    filename = f"turns-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.{EXPORT_FORMATS[format]}"
+    # Sync generator; Starlette iterates it in the thread pool, so pymongo doesn't block the loop
+    return StreamingResponse(
+        stream_turns(chats_collection, checkpoint, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 @app.get("/api/sessions/{session_id}")
 async def get_session(session_id: str):
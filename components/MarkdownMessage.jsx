@@ -1,16 +1,243 @@
 'use client';
 
-import ReactMarkdown from 'react-markdown';
-import { Prism as SyntaxHighlighter } from 'react-syntax-highlighter';
 import { vscDarkPlus, oneLight } from 'react-syntax-highlighter/dist/esm/styles/prism';
-import remarkGfm from 'remark-gfm';
 import { Copy, Check, FileText, Terminal } from 'lucide-react';
-import { useState, memo, useMemo, useEffect } from 'react';
+import { useState, memo, useMemo, useEffect, useId } from 'react';
+import { getRenderedBlocks, requestRender, subscribe } from '@/lib/markdown/client';
 
-// Memoized MarkdownMessage component for better performance
-const MarkdownMessage = memo(({ content, darkMode = false }) => {
-  const [copiedCode, setCopiedCode] = useState(null);
+// Enhanced language detection and icon mapping
+const LANGUAGE_ICONS = {
+  'javascript': '🟨',
+  'js': '🟨',
+  'typescript': '🔷',
+  'ts': '🔷',
+  'python': '🐍',
+  'py': '🐍',
+  'java': '☕',
+  'cpp': '⚡',
+  'c': '⚡',
+  'html': '🌐',
+  'css': '🎨',
+  'sql': '🗄️',
+  'bash': '💻',
+  'shell': '💻',
+  'json': '📦',
+  'xml': '📄',
+  'yaml': '📝',
+  'yml': '📝',
+  'markdown': '📝',
+  'md': '📝',
+  'php': '🐘',
+  'go': '🔵',
+  'rust': '🦀',
+  'ruby': '💎',
+  'swift': '🍎',
+  'kotlin': '🟣',
+  'dart': '🎯'
+};
+
+const getLanguageIcon = (language) => {
+  return LANGUAGE_ICONS[language?.toLowerCase()] || <FileText className="h-3 w-3" />;
+};
+
+// Token styles from the Prism theme objects, cached per class combination
+const tokenStyleCache = new WeakMap();
+
+const getTokenStyle = (theme, classes) => {
+  if (!classes.length) return undefined;
+  let styles = tokenStyleCache.get(theme);
+  if (!styles) {
+    styles = new Map();
+    tokenStyleCache.set(theme, styles);
+  }
+  const key = classes.join(' ');
+  if (!styles.has(key)) {
+    styles.set(key, Object.assign({}, ...classes.map(name => theme[name])));
+  }
+  return styles.get(key);
+};
+
+// Only allow link/image targets that can't run script
+const safeUrl = (url) => {
+  const value = String(url || '').trim();
+  return /^(https?:|mailto:|tel:|#|\/)/i.test(value) || !/^[a-z][a-z0-9+.-]*:/i.test(value) ? value : '';
+};
+
+const toProps = (tagName, properties = {}) => {
+  const props = {};
+  for (const [name, value] of Object.entries(properties)) {
+    if (value === null || value === undefined || value === false) continue;
+    if (name === 'className') {
+      props.className = Array.isArray(value) ? value.join(' ') : value;
+    } else if (name === 'align') {
+      props.style = { textAlign: value };
+    } else if (name === 'href' || name === 'src') {
+      props[name] = safeUrl(value);
+    } else if (/^data[A-Z]/.test(name)) {
+      props[`data-${name.slice(4).replace(/[A-Z]/g, c => `-${c.toLowerCase()}`).slice(1)}`] = value === true ? '' : String(value);
+    } else if (/^aria[A-Z]/.test(name)) {
+      props[`aria-${name.slice(4).toLowerCase()}`] = String(value);
+    } else if (['alt', 'title', 'id', 'type', 'checked', 'disabled', 'start'].includes(name)) {
+      props[name] = value;
+    }
+  }
+  if (tagName === 'input') {
+    props.readOnly = true;
+  }
+  return props;
+};
+
+// hast (from the markdown worker) -> React elements, using `components` for styled tags
+const toReact = (node, key, components) => {
+  if (node.type === 'text') {
+    return node.value;
+  }
+  if (node.type === 'root') {
+    return node.children.map((child, index) => toReact(child, index, components));
+  }
+  if (node.type === 'codeBlock') {
+    const Block = components.codeBlock;
+    return <Block key={key} language={node.language} code={node.code} lines={node.lines} />;
+  }
+  if (node.type !== 'element') {
+    return null;
+  }
+
+  const Component = components[node.tagName] || node.tagName;
+  const children = node.children?.length
+    ? node.children.map((child, index) => toReact(child, index, components))
+    : undefined;
+  return (
+    <Component key={key} {...toProps(node.tagName, node.properties)}>
+      {children}
+    </Component>
+  );
+};
+
+// One top-level markdown block; stable blocks keep their props while a
+// streamed message grows, so only the changed tail re-renders
+const MarkdownBlock = memo(({ hast, components }) => toReact(hast, undefined, components));
+
+MarkdownBlock.displayName = 'MarkdownBlock';
+
+// Code block with its own copy state, so copying doesn't re-render the message
+const CodeBlock = memo(({ language, code, lines, darkMode, isMobile }) => {
+  const [copied, setCopied] = useState(false);
+  const theme = darkMode ? vscDarkPlus : oneLight;
+  const showLineNumbers = lines.length > 5 && !isMobile;
+
+  const copyToClipboard = async () => {
+    try {
+      await navigator.clipboard.writeText(code);
+      setCopied(true);
+      setTimeout(() => setCopied(false), 2000);
+    } catch (err) {
+      console.error('Failed to copy:', err);
+    }
+  };
+
+  return (
+    <div className="relative group my-4 overflow-hidden rounded-xl border border-gray-200 dark:border-gray-700 shadow-sm">
+      {/* Enhanced header with better styling and responsive design */}
+      <div className="flex items-center justify-between bg-gradient-to-r from-gray-50 to-gray-100 dark:from-gray-800 dark:to-gray-750 px-3 sm:px-4 py-2 sm:py-3 border-b border-gray-200 dark:border-gray-600">
+        <div className="flex items-center gap-2 min-w-0">
+          <span className="text-base sm:text-lg flex-shrink-0">
+            {getLanguageIcon(language)}
+          </span>
+          <span className="text-xs sm:text-sm font-semibold text-gray-700 dark:text-gray-300 capitalize truncate">
+            {language || 'Code'}
+          </span>
+          {!isMobile && (
+            <span className="text-xs text-gray-500 dark:text-gray-400 bg-gray-200 dark:bg-gray-700 px-2 py-1 rounded-full flex-shrink-0">
+              {lines.length} lines
+            </span>
+          )}
+        </div>
+        <button
+          onClick={copyToClipboard}
+          className="flex items-center gap-1 sm:gap-2 px-2 sm:px-3 py-1 sm:py-1.5 text-xs text-gray-600 dark:text-gray-400 hover:text-gray-800 dark:hover:text-gray-200 bg-white dark:bg-gray-700 hover:bg-gray-50 dark:hover:bg-gray-600 rounded-lg border border-gray-300 dark:border-gray-600 transition-all duration-200 shadow-sm hover:shadow-md flex-shrink-0"
+          title="Copy code"
+        >
+          {copied ? (
+            <>
+              <Check className="h-3 w-3 text-green-600" />
+              {!isMobile && <span className="font-medium text-green-600">Copied!</span>}
+            </>
+          ) : (
+            <>
+              <Copy className="h-3 w-3" />
+              {!isMobile && <span className="font-medium">Copy</span>}
+            </>
+          )}
+        </button>
+      </div>
+      
+      {/* Enhanced syntax highlighter with responsive design */}
+      <div className="relative">
+        <pre
+          className="!mt-0 !mb-0 !rounded-t-none !rounded-b-xl overflow-x-auto"
+          style={{
+            ...theme['pre[class*="language-"]'],
+            margin: 0,
+            borderTopLeftRadius: 0,
+            borderTopRightRadius: 0,
+            borderBottomLeftRadius: '0.75rem',
+            borderBottomRightRadius: '0.75rem',
+            fontSize: isMobile ? '12px' : '14px',
+            lineHeight: '1.5',
+            padding: isMobile ? '1rem' : '1.25rem',
+            background: darkMode ? '#1e1e1e' : '#fafafa',
+          }}
+        >
+          <code style={{ ...theme['code[class*="language-"]'], whiteSpace: 'pre-wrap', wordBreak: 'break-word' }}>
+            {lines.map((line, lineIndex) => (
+              <div key={lineIndex} className="flex">
+                {showLineNumbers && (
+                  <span
+                    className="select-none text-right flex-shrink-0"
+                    style={{
+                      minWidth: '2.5em',
+                      paddingRight: '1em',
+                      color: darkMode ? '#6b7280' : '#9ca3af',
+                      fontSize: isMobile ? '10px' : '12px'
+                    }}
+                  >
+                    {lineIndex + 1}
+                  </span>
+                )}
+                <span className="min-w-0">
+                  {line.length ? line.map(([text, classes], tokenIndex) => (
+                    <span key={tokenIndex} style={getTokenStyle(theme, classes)}>{text}</span>
+                  )) : ' '}
+                </span>
+              </div>
+            ))}
+          </code>
+        </pre>
+      </div>
+    </div>
+  );
+});
+
+CodeBlock.displayName = 'CodeBlock';
+
+// Memoized MarkdownMessage component for better performance.
+// Parsing and highlighting happen in a Web Worker; pass cacheKey (the message
+// id) so remounts reuse the rendered blocks instead of parsing again.
+const MarkdownMessage = memo(({ content, darkMode = false, cacheKey = null }) => {
+  const instanceId = useId();
+  const renderKey = cacheKey || instanceId;
   const [isMobile, setIsMobile] = useState(false);
+  const [blocks, setBlocks] = useState(() => getRenderedBlocks(renderKey));
+
+  useEffect(() => {
+    setBlocks(getRenderedBlocks(renderKey));
+    return subscribe(renderKey, setBlocks);
+  }, [renderKey]);
+
+  useEffect(() => {
+    requestRender(renderKey, content);
+  }, [renderKey, content]);
 
   // Handle responsive detection client-side only
   useEffect(() => {
@@ -23,140 +250,20 @@ const MarkdownMessage = memo(({ content, darkMode = false }) => {
     return () => window.removeEventListener('resize', checkMobile);
   }, []);
 
-  const copyToClipboard = async (code, index) => {
-    try {
-      await navigator.clipboard.writeText(code);
-      setCopiedCode(index);
-      setTimeout(() => setCopiedCode(null), 2000);
-    } catch (err) {
-      console.error('Failed to copy:', err);
-    }
-  };
-
-  // Enhanced language detection and icon mapping - memoized
-  const getLanguageIcon = useMemo(() => (language) => {
-    const iconMap = {
-      'javascript': '🟨',
-      'js': '🟨',
-      'typescript': '🔷',
-      'ts': '🔷',
-      'python': '🐍',
-      'py': '🐍',
-      'java': '☕',
-      'cpp': '⚡',
-      'c': '⚡',
-      'html': '🌐',
-      'css': '🎨',
-      'sql': '🗄️',
-      'bash': '💻',
-      'shell': '💻',
-      'json': '📦',
-      'xml': '📄',
-      'yaml': '📝',
-      'yml': '📝',
-      'markdown': '📝',
-      'md': '📝',
-      'php': '🐘',
-      'go': '🔵',
-      'rust': '🦀',
-      'ruby': '💎',
-      'swift': '🍎',
-      'kotlin': '🟣',
-      'dart': '🎯'
-    };
-    return iconMap[language?.toLowerCase()] || <FileText className="h-3 w-3" />;
-  }, []);
-
   // Memoized components object to prevent recreation on every render
   const components = useMemo(() => ({
-    code({ node, inline, className, children, ...props }) {
-      const match = /language-(\w+)/.exec(className || '');
-      const language = match ? match[1] : '';
-      const code = String(children).replace(/\n$/, '');
-      const codeIndex = `${language}-${code.slice(0, 20)}`;
-
-      if (!inline && match) {
-        return (
-          <div className="relative group my-4 overflow-hidden rounded-xl border border-gray-200 dark:border-gray-700 shadow-sm">
-            {/* Enhanced header with better styling and responsive design */}
-            <div className="flex items-center justify-between bg-gradient-to-r from-gray-50 to-gray-100 dark:from-gray-800 dark:to-gray-750 px-3 sm:px-4 py-2 sm:py-3 border-b border-gray-200 dark:border-gray-600">
-              <div className="flex items-center gap-2 min-w-0">
-                <span className="text-base sm:text-lg flex-shrink-0">
-                  {getLanguageIcon(language)}
-                </span>
-                <span className="text-xs sm:text-sm font-semibold text-gray-700 dark:text-gray-300 capitalize truncate">
-                  {language || 'Code'}
-                </span>
-                {!isMobile && (
-                  <span className="text-xs text-gray-500 dark:text-gray-400 bg-gray-200 dark:bg-gray-700 px-2 py-1 rounded-full flex-shrink-0">
-                    {code.split('\n').length} lines
-                  </span>
-                )}
-              </div>
-              <button
-                onClick={() => copyToClipboard(code, codeIndex)}
-                className="flex items-center gap-1 sm:gap-2 px-2 sm:px-3 py-1 sm:py-1.5 text-xs text-gray-600 dark:text-gray-400 hover:text-gray-800 dark:hover:text-gray-200 bg-white dark:bg-gray-700 hover:bg-gray-50 dark:hover:bg-gray-600 rounded-lg border border-gray-300 dark:border-gray-600 transition-all duration-200 shadow-sm hover:shadow-md flex-shrink-0"
-                title="Copy code"
-              >
-                {copiedCode === codeIndex ? (
-                  <>
-                    <Check className="h-3 w-3 text-green-600" />
-                    {!isMobile && <span className="font-medium text-green-600">Copied!</span>}
-                  </>
-                ) : (
-                  <>
-                    <Copy className="h-3 w-3" />
-                    {!isMobile && <span className="font-medium">Copy</span>}
-                  </>
-                )}
-              </button>
-            </div>
-            
-            {/* Enhanced syntax highlighter with responsive design */}
-            <div className="relative">
-              <SyntaxHighlighter
-                style={darkMode ? vscDarkPlus : oneLight}
-                language={language}
-                PreTag="div"
-                className="!mt-0 !mb-0 !rounded-t-none !rounded-b-xl overflow-x-auto"
-                customStyle={{
-                  margin: 0,
-                  borderTopLeftRadius: 0,
-                  borderTopRightRadius: 0,
-                  borderBottomLeftRadius: '0.75rem',
-                  borderBottomRightRadius: '0.75rem',
-                  fontSize: isMobile ? '12px' : '14px',
-                  lineHeight: '1.5',
-                  padding: isMobile ? '1rem' : '1.25rem',
-                  background: darkMode ? '#1e1e1e' : '#fafafa',
-                }}
-                showLineNumbers={code.split('\n').length > 5 && !isMobile}
-                lineNumberStyle={{
-                  minWidth: '2.5em',
-                  paddingRight: '1em',
-                  color: darkMode ? '#6b7280' : '#9ca3af',
-                  fontSize: isMobile ? '10px' : '12px'
-                }}
-                wrapLines={true}
-                wrapLongLines={true}
-                {...props}
-              >
-                {code}
-              </SyntaxHighlighter>
-            </div>
-          </div>
-        );
-      }
-
-      return (
-        <code
-          className={`${className} bg-gray-100 dark:bg-gray-700 text-pink-600 dark:text-pink-400 px-2 py-1 rounded-md text-sm font-mono border border-gray-200 dark:border-gray-600`}
-          {...props}
-        >
-          {children}
-        </code>
-      );
-    },
+    // Fenced code blocks arrive pre-highlighted from the worker
+    codeBlock: (props) => (
+      <CodeBlock {...props} darkMode={darkMode} isMobile={isMobile} />
+    ),
+    // Inline code
+    code: ({ className, children }) => (
+      <code
+        className={`${className || ''} bg-gray-100 dark:bg-gray-700 text-pink-600 dark:text-pink-400 px-2 py-1 rounded-md text-sm font-mono border border-gray-200 dark:border-gray-600`}
+      >
+        {children}
+      </code>
+    ),
     // Responsive typography for headings
     h1: ({ children }) => (
       <h1 className="text-xl sm:text-2xl font-bold text-gray-900 dark:text-gray-100 mb-3 sm:mb-4 mt-4 sm:mt-6 first:mt-0">
@@ -248,16 +355,24 @@ const MarkdownMessage = memo(({ content, darkMode = false }) => {
     hr: () => (
       <hr className="my-4 border-gray-200 dark:border-gray-700" />
     ),
-  }), [darkMode, copiedCode, getLanguageIcon, copyToClipboard, isMobile]); // Dependencies for memoization
+  }), [darkMode, isMobile]); // Dependencies for memoization
+
+  // Until the first render lands, show the raw text rather than nothing
+  if (!blocks) {
+    return (
+      <div className="prose prose-sm max-w-none">
+        <p className="whitespace-pre-wrap text-sm sm:text-base text-gray-800 dark:text-gray-200 mb-3 leading-relaxed">
+          {content}
+        </p>
+      </div>
+    );
+  }
 
   return (
     <div className="prose prose-sm max-w-none">
-      <ReactMarkdown
-        remarkPlugins={[remarkGfm]}
-        components={components}
-      >
-        {content}
-      </ReactMarkdown>
+      {blocks.map(block => (
+        <MarkdownBlock key={block.id} hast={block.hast} components={components} />
+      ))}
     </div>
   );
 });
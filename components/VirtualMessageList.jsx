@@ -0,0 +1,190 @@
+'use client';
+
+import { useState, useRef, useEffect, useLayoutEffect, useCallback } from 'react';
+
+const DEFAULT_ESTIMATE = 120; // px assumed for rows that have never been measured
+const OVERSCAN = 800; // px rendered above and below the viewport
+const BOTTOM_THRESHOLD = 40; // px from the end that still counts as "at bottom"
+
+// Index of the first row whose bottom edge is below `position`
+const findRow = (offsets, position) => {
+  let low = 0;
+  let high = offsets.length - 2;
+  while (low < high) {
+    const mid = (low + high) >> 1;
+    if (offsets[mid + 1] <= position) {
+      low = mid + 1;
+    } else {
+      high = mid;
+    }
+  }
+  return Math.max(0, low);
+};
+
+// Windowed chat transcript: only rows near the viewport are mounted, row
+// heights are measured as they render, and the view stays pinned to the
+// bottom while the user is there.
+export default function VirtualMessageList({
+  items,
+  getKey,
+  renderItem,
+  footer = null,
+  estimateHeight = DEFAULT_ESTIMATE,
+  className = '',
+  innerClassName = '',
+  rowClassName = ''
+}) {
+  const scrollRef = useRef(null);
+  const heightsRef = useRef(new Map());
+  const elementsRef = useRef(new Map());
+  const rowRefsRef = useRef(new Map());
+  const observerRef = useRef(null);
+  const atBottomRef = useRef(true);
+  const frameRef = useRef(null);
+  const previousCountRef = useRef(items.length);
+  const [, setMeasureVersion] = useState(0);
+  const [viewport, setViewport] = useState({ top: 0, height: 0 });
+
+  // Row offsets from measured heights, falling back to the estimate
+  const keys = items.map((item, index) => getKey(item, index));
+  const offsets = new Array(items.length + 1);
+  offsets[0] = 0;
+  for (let i = 0; i < items.length; i++) {
+    offsets[i + 1] = offsets[i] + (heightsRef.current.get(keys[i]) ?? estimateHeight);
+  }
+  const totalHeight = offsets[items.length];
+
+  const getObserver = useCallback(() => {
+    if (!observerRef.current) {
+      observerRef.current = new ResizeObserver((entries) => {
+        const scroller = scrollRef.current;
+        const scrollTop = scroller ? scroller.scrollTop : 0;
+        let changed = false;
+        let anchorDelta = 0;
+
+        for (const entry of entries) {
+          const { key, offset } = entry.target.dataset;
+          const height = entry.borderBoxSize?.[0]?.blockSize ?? entry.target.offsetHeight;
+          const previous = heightsRef.current.get(key) ?? estimateHeight;
+          if (previous === height) continue;
+
+          heightsRef.current.set(key, height);
+          changed = true;
+          // Rows above the viewport grew or shrank; shift so the visible content stays put
+          if (Number(offset) + previous <= scrollTop) {
+            anchorDelta += height - previous;
+          }
+        }
+
+        if (!changed) return;
+        if (scroller && anchorDelta && !atBottomRef.current) {
+          scroller.scrollTop += anchorDelta;
+        }
+        setMeasureVersion(version => version + 1);
+      });
+    }
+    return observerRef.current;
+  }, [estimateHeight]);
+
+  useEffect(() => () => observerRef.current?.disconnect(), []);
+
+  // Stable ref callback per row so rows are only observed when they mount
+  const rowRef = useCallback((key) => {
+    let callback = rowRefsRef.current.get(key);
+    if (!callback) {
+      callback = (element) => {
+        const observer = getObserver();
+        const previous = elementsRef.current.get(key);
+        if (previous) {
+          observer.unobserve(previous);
+          elementsRef.current.delete(key);
+        }
+        if (element) {
+          elementsRef.current.set(key, element);
+          observer.observe(element);
+        } else {
+          rowRefsRef.current.delete(key);
+        }
+      };
+      rowRefsRef.current.set(key, callback);
+    }
+    return callback;
+  }, [getObserver]);
+
+  const updateViewport = useCallback(() => {
+    frameRef.current = null;
+    const scroller = scrollRef.current;
+    if (!scroller) return;
+    atBottomRef.current = scroller.scrollHeight - scroller.scrollTop - scroller.clientHeight <= BOTTOM_THRESHOLD;
+    setViewport(previous => (
+      previous.top === scroller.scrollTop && previous.height === scroller.clientHeight
+        ? previous
+        : { top: scroller.scrollTop, height: scroller.clientHeight }
+    ));
+  }, []);
+
+  // Throttle scroll updates to one per frame
+  const handleScroll = useCallback(() => {
+    if (frameRef.current === null) {
+      frameRef.current = requestAnimationFrame(updateViewport);
+    }
+  }, [updateViewport]);
+
+  useLayoutEffect(() => {
+    const scroller = scrollRef.current;
+    if (!scroller) return;
+    updateViewport();
+    const observer = new ResizeObserver(() => updateViewport());
+    observer.observe(scroller);
+    return () => {
+      observer.disconnect();
+      if (frameRef.current !== null) {
+        cancelAnimationFrame(frameRef.current);
+        frameRef.current = null;
+      }
+    };
+  }, [updateViewport]);
+
+  // Follow new messages, and stay pinned to the bottom as rows get measured
+  const hasFooter = Boolean(footer);
+  useLayoutEffect(() => {
+    const scroller = scrollRef.current;
+    if (!scroller) return;
+    const grew = items.length > previousCountRef.current;
+    previousCountRef.current = items.length;
+    if (grew || atBottomRef.current) {
+      scroller.scrollTop = scroller.scrollHeight;
+      atBottomRef.current = true;
+    }
+  }, [items.length, totalHeight, hasFooter]);
+
+  const first = items.length ? findRow(offsets, viewport.top - OVERSCAN) : 0;
+  const last = items.length ? findRow(offsets, viewport.top + viewport.height + OVERSCAN) : -1;
+
+  const rows = [];
+  for (let i = first; i <= last; i++) {
+    rows.push(
+      <div
+        key={keys[i]}
+        ref={rowRef(keys[i])}
+        data-key={keys[i]}
+        data-offset={offsets[i]}
+        className={rowClassName}
+        style={{ position: 'absolute', top: offsets[i], left: 0, right: 0 }}
+      >
+        {renderItem(items[i], i)}
+      </div>
+    );
+  }
+
+  return (
+    <div ref={scrollRef} onScroll={handleScroll} className={className}>
+      <div className={innerClassName}>
+        <div style={{ position: 'relative', height: totalHeight }}>
+          {rows}
+        </div>
+        {footer}
+      </div>
+    </div>
+  );
+}
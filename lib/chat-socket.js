@@ -0,0 +1,238 @@
+// Persistent chat channel to the backend WebSocket endpoint (/api/ws).
+// Several chats share one connection; each request gets its own stream id.
+
+const HEARTBEAT_INTERVAL = 20000; // ms between client pings
+const HEARTBEAT_TIMEOUT = 50000; // drop the socket if the server is silent this long
+const RETRY_MIN_DELAY = 1000; // ms to wait before retrying after a failed handshake
+const RETRY_MAX_DELAY = 60000;
+
+const getSocketUrl = () => {
+  if (process.env.NEXT_PUBLIC_BACKEND_WS_URL) {
+    return process.env.NEXT_PUBLIC_BACKEND_WS_URL;
+  }
+  // The ingress routes /api/* straight to the Python backend
+  const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+  return `${protocol}//${window.location.host}/api/ws`;
+};
+
+export class ChatSocket {
+  constructor(url = null) {
+    this.url = url;
+    this.socket = null;
+    this.pendingSocket = null; // handshake in progress
+    this.opening = null;
+    this.closed = false;
+    this.retryDelay = 0;
+    this.retryAt = 0; // don't attempt another handshake before this time
+    this.streams = new Map();
+    this.nextId = 0;
+    this.heartbeatTimer = null;
+    this.lastSeen = 0;
+  }
+
+  /**
+   * Open the connection if needed. Resolves with the open WebSocket, and
+   * rejects straight away while backing off from a failed handshake.
+   */
+  connect() {
+    if (this.closed) {
+      return Promise.reject(new Error('Chat socket closed'));
+    }
+    if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+      return Promise.resolve(this.socket);
+    }
+    if (this.opening) {
+      return this.opening;
+    }
+    if (Date.now() < this.retryAt) {
+      return Promise.reject(new Error('WebSocket unavailable, retrying later'));
+    }
+
+    this.opening = new Promise((resolve, reject) => {
+      const socket = new WebSocket(this.url || getSocketUrl());
+      this.pendingSocket = socket;
+
+      socket.onopen = () => {
+        if (this.closed) {
+          socket.close();
+          return;
+        }
+        this.socket = socket;
+        this.pendingSocket = null;
+        this.opening = null;
+        this.retryDelay = 0;
+        this.retryAt = 0;
+        this.lastSeen = Date.now();
+        this.startHeartbeat();
+        resolve(socket);
+      };
+      const failHandshake = () => {
+        if (this.pendingSocket === socket) {
+          this.pendingSocket = null;
+          this.opening = null;
+          // Back off so every message doesn't wait on a handshake that keeps failing
+          this.retryDelay = Math.min(this.retryDelay ? this.retryDelay * 2 : RETRY_MIN_DELAY, RETRY_MAX_DELAY);
+          this.retryAt = Date.now() + this.retryDelay;
+          reject(new Error('WebSocket connection failed'));
+        }
+      };
+      socket.onerror = failHandshake;
+      socket.onclose = () => {
+        failHandshake();
+        // Closed by close() before it opened; nothing else will settle connect()
+        reject(new Error('Chat socket closed'));
+        this.handleClose(socket);
+      };
+      socket.onmessage = (event) => this.handleFrame(event.data);
+    });
+    return this.opening;
+  }
+
+  /**
+   * Send a chat request over the socket. Resolves with { response, session_id,
+   * provider, model } once the stream finishes; onToken is called with each streamed chunk.
+   * Aborting `signal` cancels the stream and rejects with an AbortError at once.
+   */
+  async chat(payload, { onStart, onToken, signal } = {}) {
+    const socket = await this.connect();
+    const id = `s${++this.nextId}`;
+
+    return new Promise((resolve, reject) => {
+      if (signal?.aborted) {
+        reject(new DOMException('Chat request cancelled', 'AbortError'));
+        return;
+      }
+      this.streams.set(id, { resolve, reject, onStart, onToken, text: '' });
+      signal?.addEventListener('abort', () => this.cancel(id), { once: true });
+      socket.send(JSON.stringify({ ...payload, type: 'chat', id }));
+    });
+  }
+
+  /**
+   * Stop a stream. The pending chat() promise rejects with an AbortError
+   * right away; frames the server already sent for it are ignored.
+   */
+  cancel(id) {
+    const stream = this.streams.get(id);
+    if (!stream) {
+      return;
+    }
+    this.streams.delete(id);
+    this.send({ type: 'cancel', id });
+    stream.reject(new DOMException('Chat request cancelled', 'AbortError'));
+  }
+
+  /**
+   * Close the connection for good, including one still being opened.
+   */
+  close() {
+    this.closed = true;
+    this.stopHeartbeat();
+    if (this.pendingSocket) {
+      const pending = this.pendingSocket;
+      this.pendingSocket = null;
+      pending.close();
+    }
+    this.opening = null;
+    if (this.socket) {
+      this.socket.close();
+    }
+  }
+
+  send(frame) {
+    if (this.socket?.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify(frame));
+    }
+  }
+
+  startHeartbeat() {
+    this.stopHeartbeat();
+    this.heartbeatTimer = setInterval(() => {
+      if (Date.now() - this.lastSeen > HEARTBEAT_TIMEOUT) {
+        // Server went quiet; close so the next chat() reconnects
+        this.socket?.close();
+        return;
+      }
+      this.send({ type: 'ping', ts: Date.now() });
+    }, HEARTBEAT_INTERVAL);
+  }
+
+  stopHeartbeat() {
+    if (this.heartbeatTimer) {
+      clearInterval(this.heartbeatTimer);
+      this.heartbeatTimer = null;
+    }
+  }
+
+  handleClose(socket) {
+    if (this.socket !== socket) {
+      return;
+    }
+    this.socket = null;
+    this.stopHeartbeat();
+
+    // Anything still in flight is lost with the connection
+    for (const stream of this.streams.values()) {
+      stream.reject(new Error('Connection to chat server lost'));
+    }
+    this.streams.clear();
+  }
+
+  handleFrame(data) {
+    let frame;
+    try {
+      frame = JSON.parse(data);
+    } catch (error) {
+      console.error('Invalid frame from chat server:', error);
+      return;
+    }
+
+    this.lastSeen = Date.now();
+    const stream = frame.id ? this.streams.get(frame.id) : null;
+
+    switch (frame.type) {
+      case 'ping':
+        this.send({ type: 'pong', ts: frame.ts });
+        break;
+      case 'pong':
+        break;
+      case 'start':
+        stream?.onStart?.(frame);
+        break;
+      case 'token':
+        if (stream) {
+          stream.text += frame.delta;
+          stream.onToken?.(frame.delta);
+        }
+        break;
+      case 'done':
+        if (stream) {
+          this.streams.delete(frame.id);
+          // The answer was already sent as tokens; done only carries metadata
+          stream.resolve({
+            response: stream.text,
+            session_id: frame.session_id,
+            provider: frame.provider,
+            model: frame.model
+          });
+        }
+        break;
+      case 'cancelled':
+        if (stream) {
+          this.streams.delete(frame.id);
+          stream.reject(new DOMException('Chat request cancelled', 'AbortError'));
+        }
+        break;
+      case 'error':
+        if (stream) {
+          this.streams.delete(frame.id);
+          stream.reject(new Error(frame.detail || 'Failed to get response'));
+        } else if (!frame.id) {
+          console.error('Chat server error:', frame.detail);
+        }
+        break;
+      default:
+        console.warn('Unknown frame from chat server:', frame.type);
+    }
+  }
+}
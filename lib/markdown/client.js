@@ -0,0 +1,143 @@
+// Main-thread side of the markdown worker: keeps the rendered blocks for each
+// message (keyed by message id) and coalesces updates while a render is in flight.
+
+const MAX_DOCUMENTS = 500;
+
+const documents = new Map(); // key -> { source, blocks, version, wanted, inflight, listeners }
+const pending = new Map(); // request id -> { request, resolve }
+let nextRequestId = 0;
+let worker;
+let localRender = null;
+
+// Same pipeline, loaded lazily on the main thread when there is no worker
+const renderLocally = ({ key, source, baseVersion }) => {
+  if (!localRender) {
+    localRender = import('./pipeline').then(module => module.createMarkdownRenderer());
+  }
+  return localRender
+    .then(render => render(key, source, baseVersion))
+    .then(result => ({ key, ...result }))
+    .catch(error => ({ key, error: error.message || String(error) }));
+};
+
+// The worker failed to load or crashed: stop using it and finish what it was doing here
+const abandonWorker = (error) => {
+  console.warn('Markdown worker failed, rendering on the main thread:', error);
+  worker?.terminate();
+  worker = null;
+  const waiting = [...pending.values()];
+  pending.clear();
+  waiting.forEach(({ request, resolve }) => resolve(renderLocally(request)));
+};
+
+const getWorker = () => {
+  if (worker === undefined) {
+    try {
+      worker = new Worker(new URL('./markdown.worker.js', import.meta.url));
+      worker.onmessage = (event) => {
+        const entry = pending.get(event.data.id);
+        if (entry) {
+          pending.delete(event.data.id);
+          entry.resolve(event.data);
+        }
+      };
+      worker.onerror = (event) => {
+        event.preventDefault?.();
+        abandonWorker(event.message || 'worker error');
+      };
+      worker.onmessageerror = () => abandonWorker('unreadable message from worker');
+    } catch (error) {
+      console.warn('Markdown worker unavailable, rendering on the main thread:', error);
+      worker = null;
+    }
+  }
+  return worker;
+};
+
+const callRenderer = (key, source, baseVersion) => {
+  const request = { key, source, baseVersion };
+  const markdownWorker = getWorker();
+  if (!markdownWorker) {
+    return renderLocally(request);
+  }
+  const id = ++nextRequestId;
+  return new Promise((resolve) => {
+    pending.set(id, { request, resolve });
+    markdownWorker.postMessage({ id, ...request });
+  });
+};
+
+const getDocument = (key) => {
+  let doc = documents.get(key);
+  if (doc) {
+    // Refresh recency
+    documents.delete(key);
+  } else {
+    doc = { source: null, blocks: null, version: 0, wanted: null, inflight: false, listeners: new Set() };
+  }
+  documents.set(key, doc);
+
+  if (documents.size > MAX_DOCUMENTS) {
+    for (const [oldKey, oldDoc] of documents) {
+      if (documents.size <= MAX_DOCUMENTS) break;
+      if (!oldDoc.listeners.size && !oldDoc.inflight) {
+        documents.delete(oldKey);
+      }
+    }
+  }
+  return doc;
+};
+
+const pump = async (key, doc) => {
+  const source = doc.wanted;
+  doc.wanted = null;
+  doc.inflight = true;
+
+  const result = await callRenderer(key, source, doc.version);
+  doc.inflight = false;
+
+  if (result.error) {
+    console.error('Markdown render failed:', result.error);
+  } else {
+    // Stable blocks keep their identity, so only the changed tail re-renders
+    const stable = result.stableCount && doc.blocks ? doc.blocks.slice(0, result.stableCount) : [];
+    doc.blocks = stable.concat(result.tail);
+    doc.source = source;
+    doc.version = result.version;
+    doc.listeners.forEach(listener => listener(doc.blocks));
+  }
+
+  // Content changed while we were rendering; render the latest version only
+  if (doc.wanted !== null && doc.wanted !== doc.source) {
+    pump(key, doc);
+  }
+};
+
+/**
+ * Blocks from the last finished render of `key`, or null if it was never rendered.
+ */
+export const getRenderedBlocks = (key) => documents.get(key)?.blocks || null;
+
+/**
+ * Call `listener(blocks)` whenever a new render of `key` lands. Returns an unsubscribe function.
+ */
+export const subscribe = (key, listener) => {
+  const doc = getDocument(key);
+  doc.listeners.add(listener);
+  return () => doc.listeners.delete(listener);
+};
+
+/**
+ * Ask for `source` to be rendered under `key`. Renders already in flight are
+ * not interrupted; the latest requested source is rendered once they finish.
+ */
+export const requestRender = (key, source) => {
+  const doc = getDocument(key);
+  if (doc.source === source && !doc.inflight) {
+    return;
+  }
+  doc.wanted = source;
+  if (!doc.inflight) {
+    pump(key, doc);
+  }
+};
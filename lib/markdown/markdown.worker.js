@@ -0,0 +1,22 @@
+// Parses and highlights markdown off the main thread.
+// Request:  { id, key, source, baseVersion }
+// Response: { id, key, version, stableCount, tail } or { id, key, error }
+
+import { createMarkdownRenderer } from './pipeline';
+
+const render = createMarkdownRenderer();
+
+// Requests are handled one at a time so each document's state stays consistent
+let queue = Promise.resolve();
+
+self.onmessage = (event) => {
+  const { id, key, source, baseVersion } = event.data;
+  queue = queue.then(async () => {
+    try {
+      const result = await render(key, source, baseVersion);
+      self.postMessage({ id, key, ...result });
+    } catch (error) {
+      self.postMessage({ id, key, error: error.message || String(error) });
+    }
+  });
+};
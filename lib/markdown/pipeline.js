@@ -0,0 +1,226 @@
+// Markdown -> highlighted hast, split into top-level blocks.
+// Runs inside the markdown worker (see markdown.worker.js); the main thread only
+// turns the resulting blocks into React elements.
+
+import { fromMarkdown } from 'mdast-util-from-markdown';
+import { gfm } from 'micromark-extension-gfm';
+import { gfmFromMarkdown } from 'mdast-util-gfm';
+import { toHast } from 'mdast-util-to-hast';
+import refractor from 'refractor/core';
+
+const MAX_DOCUMENTS = 200;
+const MAX_HIGHLIGHTS = 500;
+
+const PARSE_OPTIONS = {
+  extensions: [gfm()],
+  mdastExtensions: [gfmFromMarkdown()]
+};
+
+// Fence names people actually use -> refractor language files
+const LANGUAGE_ALIASES = {
+  'js': 'javascript',
+  'ts': 'typescript',
+  'py': 'python',
+  'sh': 'bash',
+  'shell': 'bash',
+  'zsh': 'bash',
+  'yml': 'yaml',
+  'md': 'markdown',
+  'html': 'markup',
+  'xml': 'markup',
+  'svg': 'markup',
+  'c++': 'cpp',
+  'cs': 'csharp',
+  'rb': 'ruby',
+  'rs': 'rust',
+  'kt': 'kotlin'
+};
+
+const languageLoads = new Map();
+const highlights = new Map(); // `${grammar}\n${code}` -> lines, least recently used first
+
+// Load a Prism grammar the first time a code block needs it. Each language
+// file is its own chunk, so only the languages that appear get downloaded.
+const loadLanguage = (language) => {
+  const name = LANGUAGE_ALIASES[language] || language;
+  if (!name || !/^[a-z0-9]+$/.test(name)) {
+    return Promise.resolve(null);
+  }
+  if (refractor.registered(name)) {
+    return Promise.resolve(name);
+  }
+  if (!languageLoads.has(name)) {
+    languageLoads.set(name, import(
+      /* webpackChunkName: "prism-[request]" */
+      `refractor/lang/${name}.js`
+    ).then((module) => {
+      refractor.register(module.default || module);
+      return name;
+    }).catch(() => null));
+  }
+  return languageLoads.get(name);
+};
+
+// Flatten refractor output into lines of [text, classNames] tokens
+const tokensToLines = (nodes) => {
+  const lines = [[]];
+  const walk = (children, classes) => {
+    for (const node of children) {
+      if (node.type === 'text') {
+        node.value.split('\n').forEach((part, index) => {
+          if (index > 0) {
+            lines.push([]);
+          }
+          if (part) {
+            lines[lines.length - 1].push([part, classes]);
+          }
+        });
+      } else if (node.children) {
+        walk(node.children, classes.concat(node.properties?.className || []));
+      }
+    }
+  };
+  walk(nodes, []);
+  return lines;
+};
+
+// Every render re-converts the whole document, so reuse highlighting of unchanged code
+const highlight = (code, grammar) => {
+  const cacheKey = `${grammar}\n${code}`;
+  let lines = highlights.get(cacheKey);
+  if (lines) {
+    highlights.delete(cacheKey);
+  } else {
+    lines = tokensToLines(refractor.highlight(code, grammar));
+    if (highlights.size >= MAX_HIGHLIGHTS) {
+      highlights.delete(highlights.keys().next().value);
+    }
+  }
+  highlights.set(cacheKey, lines);
+  return lines;
+};
+
+const textContent = (node) => {
+  if (node.type === 'text') {
+    return node.value;
+  }
+  return (node.children || []).map(textContent).join('');
+};
+
+// Replace <pre><code class="language-x"> with a codeBlock node carrying
+// highlighted lines, and drop source positions before posting the tree back
+const highlightCodeBlocks = async (node) => {
+  delete node.position;
+  if (!node.children) {
+    return node;
+  }
+
+  for (let i = 0; i < node.children.length; i++) {
+    const child = node.children[i];
+    const code = child.type === 'element' && child.tagName === 'pre' ? child.children?.[0] : null;
+
+    if (code && code.type === 'element' && code.tagName === 'code') {
+      const classNames = code.properties?.className || [];
+      const languageClass = classNames.find(name => String(name).startsWith('language-'));
+      const language = languageClass ? String(languageClass).slice('language-'.length).toLowerCase() : '';
+      const text = textContent(code).replace(/\n$/, '');
+      const grammar = language ? await loadLanguage(language) : null;
+
+      node.children[i] = {
+        type: 'codeBlock',
+        language,
+        code: text,
+        lines: grammar
+          ? highlight(text, grammar)
+          : text.split('\n').map(line => (line ? [[line, []]] : []))
+      };
+    } else {
+      await highlightCodeBlocks(child);
+    }
+  }
+  return node;
+};
+
+// Link reference and footnote definitions. A document with any of these is
+// always re-parsed in full: micromark only resolves references against
+// definitions in the text it parses, wherever they appear.
+const DEFINITION_LINE = /^\s{0,3}\[[^\]]+\]:.*$/gm;
+const FOOTNOTE_MARK = '[^';
+
+const definitionsOf = (source) => (source.match(DEFINITION_LINE) || []).join('\n');
+
+// Parse source from `offset` on and split the result into top-level blocks
+const renderBlocks = async (key, source, offset) => {
+  const tree = fromMarkdown(source.slice(offset), PARSE_OPTIONS);
+  // Per-message prefix keeps footnote ids unique when several messages are on screen
+  const hast = toHast(tree, { clobberPrefix: `md-${key}-` });
+  const blocks = [];
+  for (const [index, node] of hast.children.entries()) {
+    if (node.type === 'text' && !node.value.trim()) {
+      continue;
+    }
+    // The generated footnotes section has no source position and is never reused
+    const start = node.position ? offset + node.position.start.offset : null;
+    const text = node.position ? source.slice(start, offset + node.position.end.offset) : null;
+    const hastBlock = await highlightCodeBlocks({ type: 'root', children: [node] });
+    blocks.push({ id: start === null ? `generated-${index}` : String(start), start, text, hast: hastBlock });
+  }
+  return blocks;
+};
+
+const sameBlock = (a, b) => a.text !== null && a.id === b.id && a.text === b.text;
+
+/**
+ * Create a renderer that remembers the last result per document key.
+ *
+ * When a document only grew (streamed tokens), every block but the last is
+ * kept and parsing restarts at the last block's offset, since appended text
+ * can only change the block it lands in. Documents with link reference or
+ * footnote definitions are re-parsed in full instead. Returns
+ * { version, stableCount, tail }: keep the first stableCount blocks of the
+ * previous result and append tail.
+ */
+export const createMarkdownRenderer = () => {
+  const documents = new Map();
+
+  return async function render(key, source, baseVersion) {
+    const previous = documents.get(key);
+    const definitions = definitionsOf(source);
+    const hasReferences = definitions !== '' || source.includes(FOOTNOTE_MARK);
+
+    let blocks;
+    if (previous && previous.source === source) {
+      blocks = previous.blocks;
+    } else if (previous && !hasReferences && previous.blocks.length > 0 && source.startsWith(previous.source)
+        && previous.blocks[previous.blocks.length - 1].start !== null) {
+      const kept = previous.blocks.slice(0, -1);
+      blocks = kept.concat(await renderBlocks(key, source, previous.blocks[kept.length].start));
+    } else {
+      blocks = await renderBlocks(key, source, 0);
+    }
+
+    // Only blocks of the version the caller holds can be kept, and a changed
+    // definition can alter blocks whose own text did not change
+    let stableCount = 0;
+    if (previous && previous.version === baseVersion && previous.definitions === definitions) {
+      const limit = Math.min(previous.blocks.length, blocks.length);
+      while (stableCount < limit && sameBlock(previous.blocks[stableCount], blocks[stableCount])) {
+        stableCount++;
+      }
+    }
+    const version = (previous?.version || 0) + 1;
+
+    // Least recently rendered documents are forgotten first
+    documents.delete(key);
+    documents.set(key, { source, blocks, version, definitions });
+    if (documents.size > MAX_DOCUMENTS) {
+      documents.delete(documents.keys().next().value);
+    }
+
+    return {
+      version,
+      stableCount,
+      tail: blocks.slice(stableCount).map(({ id, hast }) => ({ id, hast }))
+    };
+  };
+};
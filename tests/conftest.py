@@ -0,0 +1,49 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# The backend is run from its own directory (python server.py), so import it the same way
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+class FakeLlmChat:
+    """Stands in for emergentintegrations' LlmChat; set response/delay on the fixture's class"""
+
+    response = "Hello from the fake provider."
+    delay = 0.0
+    calls = 0
+
+    def __init__(self, api_key, session_id, system_message):
+        self.session_id = session_id
+
+    def with_model(self, provider, model):
+        return self
+
+    async def send_message(self, message):
+        type(self).calls += 1
+        await asyncio.sleep(self.delay)
+        return self.response
+
+class FakeCollection:
+    def __init__(self):
+        self.inserted = []
+
+    def insert_one(self, record):
+        self.inserted.append(record)
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    import server
+
+    llm = type("FakeLlmChat", (FakeLlmChat,), {})
+    monkeypatch.setattr(server, "LlmChat", llm)
+    return llm
+
+@pytest.fixture
+def fake_chats(monkeypatch):
+    import server
+
+    chats = FakeCollection()
+    monkeypatch.setattr(server, "chats_collection", chats)
+    return chats
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import httpx
+
+import server
+
+def chat_body(**fields):
+    return {"messages": [{"role": "user", "content": "hi"}], "apiKey": "test-key", **fields}
+
+def metrics_delta(before):
+    return {name: server.CHAT_METRICS[name] - value for name, value in before.items() if server.CHAT_METRICS[name] != value}
+
+async def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition never became true"
+        await asyncio.sleep(0.01)
+
+def http_client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+
+def test_cancel_during_provider_call_returns_499(fake_llm, fake_chats):
+    fake_llm.delay = 5
+    before = dict(server.CHAT_METRICS)
+
+    async def scenario():
+        async with http_client() as client:
+            chat = asyncio.create_task(client.post("/api/chat", json=chat_body(request_id="r1")))
+            await wait_for(lambda: fake_llm.calls == 1)
+            cancel = await client.post("/api/chat/r1/cancel")
+            return await chat, cancel
+
+    response, cancel = asyncio.run(scenario())
+    assert cancel.json() == {"request_id": "r1", "cancelled": True}
+    assert response.status_code == 499
+    assert not fake_chats.inserted
+    delta = metrics_delta(before)
+    assert delta.pop("chat_cancelled_provider_seconds") > 0
+    assert delta == {"chat_requests": 1, "chat_cancelled": 1, "chat_cancelled_by_client": 1}
+    assert "r1" not in server.inflight_chats
+
+def test_cancel_after_completion_changes_nothing(fake_llm, fake_chats):
+    before = dict(server.CHAT_METRICS)
+
+    async def scenario():
+        async with http_client() as client:
+            response = await client.post("/api/chat", json=chat_body(request_id="r2"))
+            cancel = await client.post("/api/chat/r2/cancel")
+            return response, cancel
+
+    response, cancel = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert response.json()["response"] == fake_llm.response
+    assert cancel.json() == {"request_id": "r2", "cancelled": False}
+    assert metrics_delta(before) == {"chat_requests": 1, "chat_completed": 1}
+
+def test_cancel_while_forwarding_finished_answer_is_not_counted(fake_llm, fake_chats):
+    before = dict(server.CHAT_METRICS)
+
+    async def scenario():
+        # Like a websocket stream sending token frames after complete_chat returned
+        async def stream():
+            await server.complete_chat(server.ChatRequest(**chat_body()))
+            await asyncio.sleep(5)
+
+        task = asyncio.create_task(stream())
+        await wait_for(lambda: server.CHAT_METRICS["chat_completed"] > before["chat_completed"])
+        assert server.cancel_chat_task(task, "client")
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert metrics_delta(before) == {"chat_requests": 1, "chat_completed": 1}
+
+def test_cancel_unknown_request():
+    async def scenario():
+        async with http_client() as client:
+            return await client.post("/api/chat/missing/cancel")
+
+    assert asyncio.run(scenario()).json() == {"request_id": "missing", "cancelled": False}
+
+def test_disconnect_cancels_provider_call(fake_llm, fake_chats):
+    fake_llm.delay = 5
+    before = dict(server.CHAT_METRICS)
+
+    class GoneRequest:
+        async def is_disconnected(self):
+            return True
+
+    async def scenario():
+        task = asyncio.create_task(server.complete_chat(server.ChatRequest(**chat_body())))
+        await wait_for(lambda: fake_llm.calls == 1)
+        await server.watch_disconnect(GoneRequest(), task)
+        await asyncio.gather(task, return_exceptions=True)
+        return task
+
+    assert asyncio.run(scenario()).cancelled()
+    delta = metrics_delta(before)
+    delta.pop("chat_cancelled_provider_seconds")
+    assert delta == {"chat_requests": 1, "chat_cancelled": 1, "chat_cancelled_by_disconnect": 1}
+
+def test_cancel_during_save_keeps_record_and_counts_wasted(fake_llm, fake_chats, monkeypatch):
+    saving = []
+
+    def slow_insert(record):
+        saving.append(record)
+        time.sleep(0.2)
+        fake_chats.inserted.append(record)
+
+    monkeypatch.setattr(fake_chats, "insert_one", slow_insert)
+    before = dict(server.CHAT_METRICS)
+
+    async def scenario():
+        task = asyncio.create_task(server.complete_chat(server.ChatRequest(**chat_body())))
+        await wait_for(lambda: saving)
+        server.cancel_chat_task(task, "client")
+        await asyncio.gather(task, return_exceptions=True)
+        # The insert carries on in the thread pool
+        await wait_for(lambda: fake_chats.inserted)
+
+    asyncio.run(scenario())
+    assert len(fake_chats.inserted) == 1
+    assert metrics_delta(before) == {
+        "chat_requests": 1,
+        "chat_cancelled": 1,
+        "chat_cancelled_by_client": 1,
+        "chat_wasted_responses": 1,
+    }
@@ -0,0 +1,191 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import ChatScheduler
+
+async def settle():
+    # Let queued tasks reach their await points
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+async def run_queued(scheduler, calls):
+    """Hold the only slot, queue (label, priority, key) calls, then release and record dispatch order"""
+    order = []
+
+    async def call(label, priority, key):
+        async with scheduler.slot(priority, key):
+            order.append(label)
+
+    await scheduler.acquire("interactive", "blocker", float("inf"), 0.0)
+    tasks = []
+    for label, priority, key in calls:
+        tasks.append(asyncio.create_task(call(label, priority, key)))
+        await settle()
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+def test_interactive_class_is_weighted_over_batch():
+    async def scenario():
+        scheduler = ChatScheduler(concurrency=1)
+        calls = [(f"b{i}", "batch", "k1") for i in range(3)] + [(f"i{i}", "interactive", "k2") for i in range(3)]
+        return await run_queued(scheduler, calls)
+
+    # Interactive tags advance by 1/4 per call, batch by 1
+    assert asyncio.run(scenario()) == ["i0", "i1", "i2", "b0", "b1", "b2"]
+
+def test_keys_in_a_class_take_turns():
+    async def scenario():
+        scheduler = ChatScheduler(concurrency=1)
+        calls = [(f"a{i}", "batch", "flood") for i in range(3)] + [("b0", "batch", "quiet")]
+        return await run_queued(scheduler, calls)
+
+    # The quiet key's call is dispatched right after the flooding key's first one
+    assert asyncio.run(scenario()) == ["a0", "b0", "a1", "a2"]
+
+def test_slot_is_handed_on_when_dispatched_call_is_cancelled():
+    async def scenario():
+        scheduler = ChatScheduler(concurrency=1)
+        ran = []
+
+        async def call(label):
+            async with scheduler.slot("interactive", label):
+                ran.append(label)
+
+        await scheduler.acquire("interactive", "blocker", float("inf"), 0.0)
+        first = asyncio.create_task(call("first"))
+        await settle()
+        second = asyncio.create_task(call("second"))
+        await settle()
+
+        # The slot goes to `first`, which is cancelled before it can run
+        scheduler.release()
+        first.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        return scheduler, ran, first
+
+    scheduler, ran, first = asyncio.run(scenario())
+    assert first.cancelled()
+    assert ran == ["second"]
+    assert scheduler.active == 0
+    assert not scheduler.queued_by_key
+
+def test_cancel_while_queued_removes_call():
+    async def scenario():
+        scheduler = ChatScheduler(concurrency=1)
+        await scheduler.acquire("interactive", "blocker", float("inf"), 0.0)
+        waiter = asyncio.create_task(scheduler.acquire("batch", "k1", float("inf"), 0.0))
+        await settle()
+        assert scheduler.snapshot()["queued"] == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        snapshot = scheduler.snapshot()
+        scheduler.release()
+        return scheduler, snapshot
+
+    scheduler, snapshot = asyncio.run(scenario())
+    assert snapshot["queued"] == 0
+    assert snapshot["active_keys"] == 0
+    # The dead heap entry is skipped rather than taking the freed slot
+    assert scheduler.active == 0
+
+def test_deadline_exceeded_while_queued_returns_504():
+    async def scenario():
+        scheduler = ChatScheduler(concurrency=1)
+        await scheduler.acquire("interactive", "blocker", float("inf"), 0.0)
+        with pytest.raises(HTTPException) as excinfo:
+            async with scheduler.slot("interactive", "k1", deadline_ms=20):
+                pass
+        return scheduler, excinfo.value
+
+    scheduler, error = asyncio.run(scenario())
+    assert error.status_code == 504
+    assert scheduler.stats["interactive"]["dropped"] == 1
+    assert scheduler.snapshot()["queued"] == 0
+
+def test_call_that_cannot_meet_its_deadline_is_dropped_at_dispatch():
+    async def scenario():
+        scheduler = ChatScheduler(concurrency=1)
+        await scheduler.acquire("interactive", "blocker", float("inf"), 0.0)
+        doomed = asyncio.create_task(scheduler.acquire("interactive", "k1", time.monotonic() + 5, 0.0))
+        await settle()
+        # Expected to take far longer than the time left
+        scheduler.queue[0][2].expected_service = 3600
+        scheduler.release()
+        with pytest.raises(HTTPException) as excinfo:
+            await doomed
+        return scheduler, excinfo.value
+
+    scheduler, error = asyncio.run(scenario())
+    assert error.status_code == 504
+    assert scheduler.active == 0
+
+def test_call_that_cannot_meet_its_deadline_is_dropped_without_queueing():
+    async def scenario():
+        scheduler = ChatScheduler(concurrency=1)
+        with pytest.raises(HTTPException) as excinfo:
+            await scheduler.acquire("interactive", "k1", time.monotonic() + 1, 3600)
+        return scheduler, excinfo.value
+
+    scheduler, error = asyncio.run(scenario())
+    assert error.status_code == 504
+    assert scheduler.active == 0
+    assert scheduler.stats["interactive"]["dropped"] == 1
+
+def test_provider_call_is_cut_off_at_the_deadline(fake_llm, fake_chats):
+    fake_llm.delay = 1
+    dropped = server.chat_scheduler.stats["batch"]["dropped"]
+    body = {"messages": [{"role": "user", "content": "hi"}], "apiKey": "test-key", "deadline_ms": 100}
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            started = time.monotonic()
+            response = await client.post("/api/chat", json=body)
+            return response, time.monotonic() - started
+
+    response, elapsed = asyncio.run(scenario())
+    assert response.status_code == 504
+    assert elapsed < 0.5
+    assert server.chat_scheduler.stats["batch"]["dropped"] == dropped + 1
+    assert not fake_chats.inserted
+    # Our own deadline isn't held against the model
+    assert server.model_router.stats.get("openai/gpt-4o-mini", {}).get("errors", 0) == 0
+
+def test_queue_limit_per_key_returns_429(monkeypatch):
+    monkeypatch.setattr(server, "SCHEDULER_MAX_QUEUE_PER_KEY", 2)
+
+    async def scenario():
+        scheduler = ChatScheduler(concurrency=1)
+        await scheduler.acquire("interactive", "blocker", float("inf"), 0.0)
+        waiters = [asyncio.create_task(scheduler.acquire("batch", "k1", float("inf"), 0.0)) for _ in range(2)]
+        await settle()
+        with pytest.raises(HTTPException) as excinfo:
+            await scheduler.acquire("batch", "k1", float("inf"), 0.0)
+        # Other keys are unaffected
+        other = asyncio.create_task(scheduler.acquire("batch", "k2", float("inf"), 0.0))
+        await settle()
+        queued = scheduler.snapshot()["queued"]
+        for task in waiters + [other]:
+            task.cancel()
+        await asyncio.gather(*waiters, other, return_exceptions=True)
+        return scheduler, excinfo.value, queued
+
+    scheduler, error, queued = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert scheduler.stats["batch"]["rejected"] == 1
+    assert queued == 3
+
+def test_unknown_priority_is_rejected():
+    async def scenario():
+        async with ChatScheduler(concurrency=1).slot("urgent", "k1"):
+            pass
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(scenario())
+    assert excinfo.value.status_code == 400
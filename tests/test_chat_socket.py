@@ -0,0 +1,79 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+def chat_frame(stream_id, **fields):
+    return {"type": "chat", "id": stream_id, "messages": [{"role": "user", "content": "hi"}], "apiKey": "test-key", **fields}
+
+def receive_until(websocket, frame_type):
+    """Frames up to and including the first one of frame_type"""
+    frames = []
+    while True:
+        frame = websocket.receive_json()
+        frames.append(frame)
+        if frame["type"] == frame_type:
+            return frames
+
+@pytest.fixture
+def client(fake_llm, fake_chats):
+    return TestClient(server.app)
+
+def test_stream_sends_start_tokens_then_done(client, fake_llm, fake_chats):
+    fake_llm.response = "streamed " * 40
+    with client.websocket_connect("/api/ws") as websocket:
+        websocket.send_json(chat_frame("s1"))
+        frames = receive_until(websocket, "done")
+
+    assert [frame["type"] for frame in frames] == ["start"] + ["token"] * (len(frames) - 2) + ["done"]
+    assert len(frames) - 2 == -(-len(fake_llm.response) // server.WS_CHUNK_SIZE)
+    assert "".join(frame["delta"] for frame in frames[1:-1]) == fake_llm.response
+    assert all(frame["id"] == "s1" for frame in frames)
+
+    start, done = frames[0], frames[-1]
+    assert done["session_id"] == start["session_id"]
+    assert (done["provider"], done["model"]) == ("openai", "gpt-4o-mini")
+    # The answer is only carried by the token frames
+    assert "response" not in done
+    assert len(fake_chats.inserted) == 1
+
+def test_cancel_frame_stops_stream(client, fake_llm, fake_chats):
+    fake_llm.delay = 5
+    with client.websocket_connect("/api/ws") as websocket:
+        websocket.send_json(chat_frame("s1"))
+        assert websocket.receive_json()["type"] == "start"
+        websocket.send_json({"type": "cancel", "id": "s1"})
+        assert websocket.receive_json() == {"type": "cancelled", "id": "s1"}
+
+    assert not fake_chats.inserted
+
+def test_duplicate_stream_id_is_rejected(client, fake_llm):
+    fake_llm.delay = 5
+    with client.websocket_connect("/api/ws") as websocket:
+        websocket.send_json(chat_frame("s1"))
+        websocket.send_json(chat_frame("s1"))
+        error = receive_until(websocket, "error")[-1]
+
+    assert error == {"type": "error", "id": "s1", "detail": "Stream id already in use"}
+
+def test_concurrent_stream_limit(client, fake_llm, monkeypatch):
+    monkeypatch.setattr(server, "WS_MAX_STREAMS", 1)
+    fake_llm.delay = 5
+    with client.websocket_connect("/api/ws") as websocket:
+        websocket.send_json(chat_frame("s1"))
+        websocket.send_json(chat_frame("s2"))
+        error = receive_until(websocket, "error")[-1]
+
+    assert error == {"type": "error", "id": "s2", "detail": "Too many concurrent streams"}
+
+@pytest.mark.parametrize("text, detail", [
+    ("not json", "Frames must be JSON"),
+    ("[1, 2]", "Frames must be JSON objects"),
+    ('"chat"', "Frames must be JSON objects"),
+])
+def test_invalid_frames_get_an_error_and_keep_the_socket(client, text, detail):
+    with client.websocket_connect("/api/ws") as websocket:
+        websocket.send_text(text)
+        assert websocket.receive_json() == {"type": "error", "detail": detail}
+        websocket.send_json({"type": "ping", "ts": 1})
+        assert websocket.receive_json() == {"type": "pong", "ts": 1}
@@ -0,0 +1,128 @@
+import io
+import os
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import export_turns
+from export_turns import TURN_SCHEMA, export_to_directory, load_checkpoint, stream_turns
+
+class FakeChats:
+    """Stands in for the chats collection, applying turn_pipeline's $match and projection"""
+
+    def __init__(self, records):
+        self.records = records
+
+    def aggregate(self, pipeline, **kwargs):
+        match = pipeline[0]["$match"]
+        docs = sorted(self.records, key=lambda r: (r["timestamp"], r["_id"]))
+        for record in docs:
+            if "timestamp" in match and not record["timestamp"] < match["timestamp"]["$lt"]:
+                continue
+            if "$or" in match:
+                after, same_time = match["$or"]
+                if not (record["timestamp"] > after["timestamp"]["$gt"]
+                        or (record["timestamp"] == same_time["timestamp"] and record["_id"] > same_time["_id"]["$gt"])):
+                    continue
+            yield {
+                "_id": record["_id"],
+                "session_id": record["session_id"],
+                "provider": record["provider"],
+                "model": record["model"],
+                "timestamp": record["timestamp"],
+                "history_length": len(record["messages"]),
+                "user_role": record["messages"][-1]["role"],
+                "user_length": len(record["messages"][-1]["content"]),
+                "response_length": len(record["response"]),
+            }
+
+def chat_record(chat_id, timestamp, turns=1):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i}"})
+        if i < turns - 1:
+            messages.append({"role": "assistant", "content": f"answer {i}"})
+    return {
+        "_id": chat_id,
+        "session_id": "s1",
+        "provider": "openai",
+        "model": "gpt-4o-mini",
+        "messages": messages,
+        "response": "x" * 10,
+        "timestamp": timestamp,
+    }
+
+def read_dir(out_dir):
+    tables = []
+    for root, _, files in os.walk(out_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(".parquet"):
+                tables.append(pq.read_table(path))
+            elif name.endswith(".arrow"):
+                tables.append(pa.ipc.open_file(path).read_all())
+    return pa.concat_tables(tables) if tables else None
+
+def test_each_record_adds_only_its_own_turns():
+    start = datetime(2025, 1, 1, 12)
+    chats = FakeChats([chat_record("a", start, turns=1), chat_record("b", start + timedelta(minutes=1), turns=2)])
+    batches = [batch for _, batch, _ in export_turns.iter_turn_batches(chats)]
+    rows = pa.Table.from_batches(batches, schema=TURN_SCHEMA).to_pydict()
+
+    assert rows["chat_id"] == ["a", "a", "b", "b"]
+    assert rows["turn_index"] == [0, 1, 2, 3]
+    assert rows["role"] == ["user", "assistant", "user", "assistant"]
+    assert rows["content_length"] == [len("question 0"), 10, len("question 1"), 10]
+    assert rows["tokens_estimate"] == [3, 3, 3, 3]
+
+def test_batches_never_span_dates():
+    midnight = datetime(2025, 1, 2)
+    chats = FakeChats([chat_record("a", midnight - timedelta(minutes=1)), chat_record("b", midnight)])
+    dates = [date for date, _, _ in export_turns.iter_turn_batches(chats)]
+    assert dates == ["2025-01-01", "2025-01-02"]
+
+def test_incremental_export_resumes_from_checkpoint(tmp_path):
+    now = datetime.utcnow()
+    records = [chat_record("a", now - timedelta(days=1)), chat_record("b", now - timedelta(hours=1))]
+    chats = FakeChats(records)
+
+    first = export_to_directory(chats, str(tmp_path))
+    assert first["rows"] == 4
+    assert load_checkpoint(str(tmp_path))["_id"] == "b"
+
+    assert export_to_directory(chats, str(tmp_path))["rows"] == 0
+
+    records.append(chat_record("c", now - timedelta(minutes=30)))
+    third = export_to_directory(chats, str(tmp_path), format="arrow")
+    assert third["rows"] == 2
+    assert sorted(set(read_dir(str(tmp_path)).column("chat_id").to_pylist())) == ["a", "b", "c"]
+
+def test_recent_records_wait_for_next_run(tmp_path):
+    now = datetime.utcnow()
+    records = [chat_record("old", now - timedelta(hours=1)), chat_record("fresh", now)]
+    summary = export_to_directory(FakeChats(records), str(tmp_path))
+
+    assert summary["rows"] == 2
+    # The checkpoint stays behind records that may still be arriving
+    assert load_checkpoint(str(tmp_path))["_id"] == "old"
+
+def test_runs_in_the_same_second_keep_their_files(tmp_path):
+    now = datetime.utcnow()
+    records = [chat_record("a", now - timedelta(hours=2))]
+    chats = FakeChats(records)
+    export_to_directory(chats, str(tmp_path))
+    records.append(chat_record("b", now - timedelta(hours=2) + timedelta(seconds=1)))
+    export_to_directory(chats, str(tmp_path))
+
+    assert sorted(read_dir(str(tmp_path)).column("chat_id").to_pylist()) == ["a", "a", "b", "b"]
+
+def test_stream_turns_produces_readable_output():
+    start = datetime(2025, 1, 1)
+    chats = FakeChats([chat_record(f"c{i}", start + timedelta(hours=i * 7)) for i in range(5)])
+
+    arrow = b"".join(stream_turns(chats, format="arrow"))
+    assert pa.ipc.open_stream(arrow).read_all().num_rows == 10
+
+    parquet = b"".join(stream_turns(chats, format="parquet"))
+    assert pq.read_table(io.BytesIO(parquet)).num_rows == 10
@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import pytest
+
+import server
+from server import ModelRouter, is_provider_failure
+
+def route(router, policy="fastest", provider="openai", prompt_chars=100):
+    return router.route(provider, prompt_chars, policy)["model"]
+
+def test_unobserved_models_use_tier_prior():
+    router = ModelRouter(alpha=0.2)
+    # Quality 1 models have the lowest prior latency
+    assert route(router) == "gpt-4.1-nano"
+
+def test_first_sample_is_blended_with_prior():
+    router = ModelRouter(alpha=0.5)
+    router.record("openai", "gpt-4.1-nano", 4.0)
+    prior = server.ROUTER_PRIOR_LATENCY[1]
+    assert router.stats["openai/gpt-4.1-nano"]["latency"] == pytest.approx(prior + 0.5 * (4.0 - prior))
+
+def test_single_error_does_not_exclude_model():
+    router = ModelRouter(alpha=0.2)
+    router.record("openai", "gpt-4.1-nano", 0.1, error=True)
+    assert router.expected("openai", "gpt-4.1-nano")["error_rate"] == pytest.approx(0.2)
+    assert route(router) == "gpt-4.1-nano"
+
+def test_failure_latency_is_not_recorded():
+    router = ModelRouter(alpha=0.2)
+    router.record("openai", "gpt-4o", 0.01, error=True)
+    stats = router.stats["openai/gpt-4o"]
+    assert stats["latency"] == server.ROUTER_PRIOR_LATENCY[3]
+    assert stats["samples"] == 0
+    assert stats["errors"] == 1
+
+def test_excluded_model_recovers_as_errors_decay():
+    router = ModelRouter(alpha=0.5, error_half_life=10)
+    for _ in range(5):
+        router.record("openai", "gpt-4.1-nano", 0.1, error=True)
+    assert route(router) != "gpt-4.1-nano"
+
+    # Pretend the failures happened a minute ago
+    router.stats["openai/gpt-4.1-nano"]["updated"] = time.monotonic() - 60
+    assert router.expected("openai", "gpt-4.1-nano")["error_rate"] < server.ROUTER_MAX_ERROR_RATE
+    assert route(router) == "gpt-4.1-nano"
+
+def test_slow_sample_fades_back_toward_prior():
+    router = ModelRouter(alpha=0.2, latency_half_life=600)
+    router.record("openai", "gpt-4.1-nano", 60.0)
+    assert router.expected("openai", "gpt-4.1-nano")["latency"] > server.ROUTER_LATENCY_SLO
+    assert route(router) != "gpt-4.1-nano"
+    assert route(router, policy="cheapest") != "gpt-4.1-nano"
+
+    # A day without samples brings it back to the tier prior, so it gets picked and measured again
+    router.stats["openai/gpt-4.1-nano"]["updated"] = time.monotonic() - 86400
+    assert router.expected("openai", "gpt-4.1-nano")["latency"] == pytest.approx(server.ROUTER_PRIOR_LATENCY[1])
+    assert route(router) == "gpt-4.1-nano"
+    assert route(router, policy="cheapest") == "gpt-4.1-nano"
+
+def test_long_prompts_need_capable_models():
+    router = ModelRouter(alpha=0.2)
+    model = route(router, prompt_chars=server.ROUTER_HUGE_PROMPT_CHARS)
+    assert server.MODEL_PROFILES["openai"][model]["quality"] == 3
+
+def test_cheapest_policy_prefers_low_cost_within_slo():
+    router = ModelRouter(alpha=0.2)
+    model = route(router, policy="cheapest", prompt_chars=server.ROUTER_LONG_PROMPT_CHARS)
+    assert server.MODEL_PROFILES["openai"][model] == {"cost": 1, "quality": 2}
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+@pytest.mark.parametrize("error, expected", [
+    (asyncio.TimeoutError(), True),
+    (ConnectionError("reset"), True),
+    (StatusError(503), True),
+    (StatusError(429), True),
+    (StatusError(401), False),
+    (StatusError(400), False),
+    (Exception("litellm.AuthenticationError: Incorrect API key provided"), False),
+    (Exception("litellm.ServiceUnavailableError: model overloaded"), True),
+    (ValueError("Last message must be from user"), False),
+])
+def test_only_provider_failures_count_as_errors(error, expected):
+    assert is_provider_failure(error) is expected